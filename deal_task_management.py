@@ -1,10 +1,30 @@
 import pandas as pd
+import numpy as np
 import streamlit as st
 import re
-from bs4 import BeautifulSoup
+import os
+import shutil
+import hashlib
+import functools
+import itertools
+import operator
+import importlib.util
+import threading
+import time
 from io import BytesIO
+from pathlib import Path
+from collections import OrderedDict
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-import plotly.express as px
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+import sqlite3
+
+# plotly, BeautifulSoup, xlsxwriter, pyarrow and DuckDB are imported by the features that use them,
+# so a new session's first page does not wait for modules it may never need (see import_benchmark.py)
+
+# Copy-on-write keeps the cached frames shared between reruns from being modified in place
+pd.options.mode.copy_on_write = True
 
 # Set the layout to wide
 st.set_page_config(layout="wide")
@@ -58,95 +78,95 @@ st.markdown(
     unsafe_allow_html=True
 )
 
+# Pattern of the parenthesized qualifiers the CRM appends to headers, e.g. '(Regarding) (Deal)'
+COLUMN_QUALIFIER_PATTERN = re.compile(r'\s*\(.*?\)')
+
 # Function to clean up the column names by stripping out '(Regarding) (Deal)'
 def clean_column_names(columns):
-    return [re.sub(r'\s*\(.*?\)', '', col).strip() for col in columns] 
+    return [COLUMN_QUALIFIER_PATTERN.sub('', str(col)).strip() for col in columns]
 
 # Function to strip HTML tags and retain only text
 def strip_html(text):
     if isinstance(text, str):
+        from bs4 import BeautifulSoup
         soup = BeautifulSoup(text, "html.parser")
         return soup.get_text(separator=" ", strip=True)
     return text
 
-# Function to apply conditional formatting with semi-transparency for tasks 
-# Function to apply conditional formatting with semi-transparency for tasks
-def apply_conditional_formatting(df):
-    current_date = pd.Timestamp(datetime.now().date())
-
-    # Ensure unique columns before applying styling
-    if df.columns.duplicated().any():
-        df = df.loc[:, ~df.columns.duplicated()]
-
-    # Function to style each row based on Due Date and Status Reason
-    def due_date_color(row):
-        due_date = pd.to_datetime(row['Due Date'], errors='coerce')
-        status_reason = row['Status Reason']
-
-        # Default to no coloring for the entire row
-        style = [''] * len(row)
-
-        # Apply colors only if the Status is not 'Completed'
-        if status_reason != 'Completed':
-            if pd.isna(due_date):
-                return style  # No coloring if the due date is not available
-            if current_date > due_date:
-                style[df.columns.get_loc('Due Date')] = 'background-color: rgba(255, 0, 0, 0.3)'  # Red for overdue
-            elif current_date <= due_date <= current_date + timedelta(days=5):
-                style[df.columns.get_loc('Due Date')] = 'background-color: rgba(255, 165, 0, 0.3)'  # Orange for due within 5 days
-            elif current_date + timedelta(days=5) < due_date <= current_date + timedelta(days=15):
-                style[df.columns.get_loc('Due Date')] = 'background-color: rgba(255, 255, 0, 0.3)'  # Yellow for due within 15 days
-
-        return style
-
-    # Apply styles to the DataFrame using .apply for row-wise operations
-    styled_df = df.style.apply(due_date_color, axis=1)
-
-    # Apply additional cell coloring for the "Status Reason" column (Completed, In Progress)
-    styled_df = styled_df.applymap(
-        lambda val: 'background-color: rgba(128, 128, 128, 0.3)' if val == 'Completed' else '',
-        subset=['Status Reason']
-    ).applymap(
-        lambda val: 'background-color: rgba(0, 128, 0, 0.3)' if val == 'In Progress' else '',
-        subset=['Status Reason']
-    )
-
-    return styled_df
-
-# Function to apply conditional formatting to appointments based on End Time
-def apply_appointment_formatting(df):
-    current_date = pd.Timestamp(datetime.now().date())
-
-    # Function to style each row based on End Time
-    def end_time_color(row):
-        end_time = pd.to_datetime(row['End Time'], errors='coerce')
-
-        # Default to no coloring for the entire row
-        style = [''] * len(row)
-
-        if pd.isna(end_time):
-            return style  # No coloring if the end time is not available
+# Function to format datetime columns as mm/dd/yyyy strings for display, on a copy of the frame
+def format_dates_for_display(df, date_columns):
+    return df.assign(**{col: df[col].dt.strftime('%m/%d/%Y') for col in date_columns if col in df.columns})
+
+# Urgency buckets shared by the table badges, the Gantt chart and the Excel export
+URGENCY_NONE = 0
+URGENCY_OVERDUE = 1  # Past due (tasks) or past end time (appointments)
+URGENCY_DUE_5_DAYS = 2
+URGENCY_DUE_15_DAYS = 3
+
+TASK_URGENCY_LABELS = {URGENCY_OVERDUE: 'Overdue', URGENCY_DUE_5_DAYS: 'Due within 5 days', URGENCY_DUE_15_DAYS: 'Due within 15 days'}
+APPOINTMENT_URGENCY_LABELS = {URGENCY_OVERDUE: 'Past', URGENCY_DUE_5_DAYS: 'Within 5 days', URGENCY_DUE_15_DAYS: 'Within 15 days'}
+
+# Badges shown in the tables instead of cell colors, indexed by urgency code
+TASK_URGENCY_BADGES = ['', '🔴 Overdue', '🟠 Due within 5 days', '🟡 Due within 15 days']
+APPOINTMENT_URGENCY_BADGES = ['', '⚪ Past', '🟠 Within 5 days', '🟡 Within 15 days']
+STATUS_BADGES = {'Completed': '⚪', 'In Progress': '🟢'}
+TASK_TABLE_COLUMN_CONFIG = {'Urgency': st.column_config.TextColumn("Urgency", help="Due Date relative to the as-of date; completed tasks are never urgent")}
+APPOINTMENT_TABLE_COLUMN_CONFIG = {'Urgency': st.column_config.TextColumn("Urgency", help="End Time relative to the as-of date")}
+
+# Function to classify dates into urgency buckets relative to a date, as a compact int8 array
+def classify_urgency(dates, as_of_date, active=None):
+    days_left = (dates - as_of_date).dt.days
+    urgency = np.select(
+        [days_left < 0, days_left <= 5, days_left <= 15],
+        [URGENCY_OVERDUE, URGENCY_DUE_5_DAYS, URGENCY_DUE_15_DAYS],
+        URGENCY_NONE
+    ).astype(np.int8)
+    urgency[dates.isna().to_numpy()] = URGENCY_NONE  # No urgency if the date is not available
+    if active is not None:
+        urgency[~active] = URGENCY_NONE
+    return urgency
+
+# Function to compute the urgency of every task (by Due Date) and appointment (by End Time) for a day
+def compute_urgency(tasks_df, appointments_df, as_of_date):
+    due_dates = pd.to_datetime(tasks_df['Due Date'], format='%m/%d/%Y', errors='coerce')
+    end_times = pd.to_datetime(appointments_df['End Time'], format='%m/%d/%Y', errors='coerce')
+    return {
+        # Completed tasks are never urgent
+        'tasks': pd.Series(classify_urgency(due_dates, as_of_date, (tasks_df['Status Reason'] != 'Completed').to_numpy()), index=tasks_df.index),
+        'appointments': pd.Series(classify_urgency(end_times, as_of_date), index=appointments_df.index)
+    }
 
-        # Apply colors based on proximity to the end time
-        if current_date > end_time:
-            style[df.columns.get_loc('End Time')] = 'background-color: rgba(128, 128, 128, 0.3)'  # Gray for past end time
-        elif current_date <= end_time <= current_date + timedelta(days=5):
-            style[df.columns.get_loc('End Time')] = 'background-color: rgba(255, 165, 0, 0.3)'  # Orange for within 5 days
-        elif current_date + timedelta(days=5) < end_time <= current_date + timedelta(days=15):
-            style[df.columns.get_loc('End Time')] = 'background-color: rgba(255, 255, 0, 0.3)'  # Yellow for within 15 days
+# Function to add the 'Urgency' column to a slice of the tasks or appointments
+def with_urgency(df, urgency):
+    return df.assign(Urgency=urgency.reindex(df.index, fill_value=URGENCY_NONE))
 
-        return style
+# Function to replace the 'Urgency' codes by their labels, for the Excel export
+def with_urgency_labels(df, labels):
+    return df.assign(Urgency=df['Urgency'].map(labels).fillna(''))
 
-    # Apply styles to the DataFrame using .apply for row-wise operations
-    styled_df = df.style.apply(end_time_color, axis=1)
+# Function to turn the 'Urgency' codes into a badge column placed after the date it was computed from.
+# The badges are a categorical, so the table goes to the browser as a plain Arrow frame with a small dictionary.
+def with_urgency_badges(df, badges, date_column):
+    badge_column = pd.Categorical.from_codes(df['Urgency'].to_numpy(), categories=badges)
+    columns = [col for col in df.columns if col != 'Urgency']
+    columns.insert(columns.index(date_column) + 1, 'Urgency')
+    return df.assign(Urgency=badge_column)[columns]
 
-    return styled_df
+# Function to badge tasks by the urgency of their Due Date and mark Completed / In Progress statuses
+def apply_conditional_formatting(df):
+    badged_df = with_urgency_badges(df, TASK_URGENCY_BADGES, 'Due Date')
+    status = badged_df['Status Reason'].astype('category')
+    status = status.cat.rename_categories(lambda val: f"{STATUS_BADGES[val]} {val}" if val in STATUS_BADGES else val)
+    return badged_df.assign(**{'Status Reason': status})
 
+# Function to badge appointments by the urgency of their End Time
+def apply_appointment_formatting(df):
+    return with_urgency_badges(df, APPOINTMENT_URGENCY_BADGES, 'End Time')
 
 # Gantt chart generation function
 # Gantt chart generation function
-def generate_gantt_chart(deal_name, deal, filtered_tasks_df):
-    current_date = pd.Timestamp(datetime.now().date())
+def generate_gantt_chart(deal_name, deal, filtered_tasks_df, as_of_date):
+    current_date = as_of_date
 
     gantt_data = {
         'Task': [],
@@ -197,19 +217,19 @@ def generate_gantt_chart(deal_name, deal, filtered_tasks_df):
         gantt_data['Order'].append(task_order)
         task_order += 1  # Increment order for each task
 
-        # Apply color based on status and proximity to the due date
+        # Apply color based on status and the precomputed urgency of the due date
         if status == 'Completed':
             actual_end = pd.to_datetime(task.get('Actual End', due_date), errors='coerce')
             gantt_data['Finish'][-1] = actual_end
             gantt_data['Color'].append('gray')
         elif status == 'In Progress':
-            if current_date > due_date:
+            if task['Urgency'] == URGENCY_OVERDUE:
                 gantt_data['Color'].append('red')  # Overdue
                 gantt_data['Status'][-1] = 'Overdue'
-            elif current_date <= due_date <= current_date + timedelta(days=5):
+            elif task['Urgency'] == URGENCY_DUE_5_DAYS:
                 gantt_data['Color'].append('orange')  # Due in 5 days
                 gantt_data['Status'][-1] = 'Due Soon (5 days)'
-            elif current_date + timedelta(days=5) < due_date <= current_date + timedelta(days=15):
+            elif task['Urgency'] == URGENCY_DUE_15_DAYS:
                 gantt_data['Color'].append('yellow')  # Due in 15 days
                 gantt_data['Status'][-1] = 'Due Soon (15 days)'
             else:
@@ -235,6 +255,7 @@ def generate_gantt_chart(deal_name, deal, filtered_tasks_df):
         }
 
         # Plot the Gantt chart using the Order column to control the order
+        import plotly.express as px
         fig = px.timeline(
             gantt_df.sort_values(by='Order'),  # Sort by the Order column
             x_start="Start",
@@ -268,354 +289,1719 @@ def generate_gantt_chart(deal_name, deal, filtered_tasks_df):
         return None
 
 
-# Load the Excel files
-uploaded_files = st.file_uploader(
-    "Choose Excel files",
-    type="xlsx",
-    accept_multiple_files=True,
-    help="Upload two Excel files: one for Deals/Tasks and one for Appointments"
-)
+# Define expected columns (after cleaning)
+DEAL_COLUMNS = [
+    'Regarding', 'Sub-Market', 'Calculated Deal Stage',
+    'GF Submittal Date', 'Green Folder Meeting Date',
+    'IP Expiration Date', 'Days to IP Expiration',
+    'Projected Deal First Closing Date', 'Deal Homesite Total',
+    'Homesite Size Description', 'Acquisition Type',
+    'Primary Seller Company', 'Product Type Description',
+    'CIC Final Approval Date', 'Actual Contract Execution Date'
+]
+
+TASK_COLUMNS = [
+    'Subject', 'Owner', 'Start Date', 'Due Date', 'Actual End',
+    'Status Reason', 'Vendor Assigned', 'Task Category',
+    'Modified On', 'Comment'
+]
+
+APPOINTMENT_COLUMNS = [
+    'Subject', 'Regarding', 'Owner', 'Status', 'Start Time',
+    'End Time', 'Category', 'Description'
+]
+
+DEAL_DATE_COLUMNS = ['GF Submittal Date', 'Green Folder Meeting Date', 'IP Expiration Date', 'Projected Deal First Closing Date', 'CIC Final Approval Date', 'Actual Contract Execution Date']
+
+# Rows are matched on these keys when a delta export is merged into a snapshot
+TASK_KEY_COLUMNS = ['Regarding', 'Subject']
+APPOINTMENT_KEY_COLUMNS = ['Regarding', 'Subject', 'Start Time']
+
+# Columns an export must have for its role; optional columns are added empty when missing
+REQUIRED_COLUMNS = {
+    'deals_tasks': [col for col in DEAL_COLUMNS + TASK_COLUMNS if col not in ['Actual End', 'Days to IP Expiration']],
+    'appointments': ['Subject', 'Regarding', 'Start Time', 'End Time']
+}
+OPTIONAL_COLUMNS = {
+    'deals_tasks': ['Actual End', 'Days to IP Expiration'],
+    'appointments': []
+}
+# Value a missing optional column is filled with; numeric columns must not become datetimes
+OPTIONAL_COLUMN_FILLS = {'Actual End': pd.NaT, 'Days to IP Expiration': np.nan}
+
+# Function to map a raw export header to canonical column names, cached by header.
+# Detects whether the file is the Deals/Tasks or the Appointments export, keeps the first of
+# any duplicate columns and lists the required columns that are missing.
+@functools.lru_cache(maxsize=64)
+def resolve_schema(raw_headers):
+    columns = clean_column_names(raw_headers)
+
+    # Identify which export this is based on specific columns
+    role = 'appointments' if {'Subject', 'Start Time'}.issubset(columns) else 'deals_tasks'
+
+    # Resolve duplicates in one pass; the Deals/Tasks export is also projected to the columns the app uses
+    wanted = set(DEAL_COLUMNS + TASK_COLUMNS) if role == 'deals_tasks' else None
+    positions = {}
+    for position, col in enumerate(columns):
+        if col not in positions and (wanted is None or col in wanted):
+            positions[col] = position
+
+    return {
+        'role': role,
+        'positions': tuple(positions.values()),
+        'columns': tuple(positions),
+        'missing': tuple(col for col in REQUIRED_COLUMNS[role] if col not in positions),
+        'missing_optional': tuple(col for col in OPTIONAL_COLUMNS[role] if col not in positions)
+    }
+
+# Function to read one uploaded export, checking its header before parsing any rows
+def read_export(file_contents, file_label):
+    with pd.ExcelFile(BytesIO(file_contents)) as excel_file:
+        header = excel_file.parse(nrows=0).columns
+        schema = resolve_schema(tuple(str(col) for col in header))
+        if schema['missing']:
+            raise ValueError(f"{file_label} is missing required columns: {', '.join(schema['missing'])}")
+
+        df = excel_file.parse(usecols=list(schema['positions']))
+
+    df.columns = list(schema['columns'])
+    for col in schema['missing_optional']:
+        df[col] = OPTIONAL_COLUMN_FILLS[col]  # Ensure the column exists to avoid errors
+    return schema['role'], df
+
+# Function to tell the Deals/Tasks export apart from the Appointments export
+def split_export_frames(role_frames):
+    deals_tasks = None
+    appointments = None
+    for role, frames in role_frames:
+        if role == 'appointments':
+            appointments = frames
+        else:
+            deals_tasks = frames
+    return deals_tasks, appointments
+
+# Task date fields, formatted as mm/dd/yyyy strings
+TASK_DATE_COLUMNS = ['Start Date', 'Due Date', 'Modified On', 'Actual End']
+
+# Function to type the columns of de-duplicated deal rows
+def normalize_deals(deals_df):
+    deals_df = deals_df.reset_index(drop=True)
+
+    # Keep missing values in 'Days to IP Expiration' missing; it is recomputed by add_derived_day_columns
+    deals_df['Days to IP Expiration'] = pd.to_numeric(deals_df['Days to IP Expiration'], errors='coerce').round().astype('Int64')
+
+    # Convert date fields to datetime and extract only the date; they are formatted for display when rendered
+    deals_df[DEAL_DATE_COLUMNS] = deals_df[DEAL_DATE_COLUMNS].apply(lambda x: pd.to_datetime(x, errors='coerce').dt.normalize())
+    return deals_df
+
+# Function to format the date fields of de-duplicated task rows, including "Actual End", "Start Date", "Due Date", and "Modified On"
+def normalize_tasks(tasks_df):
+    tasks_df = tasks_df.reset_index(drop=True)
+
+    # Convert to datetime and format the dates as mm/dd/yyyy
+    tasks_df[TASK_DATE_COLUMNS] = tasks_df[TASK_DATE_COLUMNS].apply(lambda x: pd.to_datetime(x, errors='coerce').dt.strftime('%m/%d/%Y'))
+    return tasks_df
+
+# Function to select columns of a frame without duplicate rows, keeping the first of each, like drop_duplicates.
+# Each column is factorized as drop_duplicates does, so values compare the same way (1, 1.0 and True are equal,
+# '1' is not), but the codes are folded into one running code per row, one column at a time, instead of
+# keeping the codes of every column at once; the selected columns are not copied either.
+def drop_duplicate_rows(df, columns=None):
+    columns = list(df.columns) if columns is None else columns
+    if len(columns) == 1:
+        # drop_duplicates compares a single column with Series.duplicated, which keeps None, NaN and <NA> apart
+        return df.loc[~df[columns[0]].duplicated().to_numpy(), columns]
+
+    row_codes = np.zeros(len(df), dtype=np.int64)
+    code_count = 1
+    for col in columns:
+        codes, uniques = pd.factorize(df[col].values)
+        # Renumber the row codes from 0 before they could overflow; missing values have code -1, so codes are shifted by one
+        if code_count * (len(uniques) + 1) >= 2 ** 62:
+            row_codes, code_uniques = pd.factorize(row_codes)
+            code_count = len(code_uniques)
+        row_codes = row_codes * (len(uniques) + 1) + (codes + 1)
+        code_count *= len(uniques) + 1
+    return df.loc[~pd.Series(row_codes).duplicated().to_numpy(), columns]
+
+# Function to extract the deals and tasks from the combined Deals/Tasks export
+def normalize_deals_tasks(deals_tasks_df):
+    # Extract deals data
+    deals_df = normalize_deals(drop_duplicate_rows(deals_tasks_df, DEAL_COLUMNS))
+
+    # Extract tasks data
+    tasks_df = normalize_tasks(drop_duplicate_rows(deals_tasks_df, TASK_COLUMNS + ['Regarding']))
+
+    # You can then sort the DataFrame by any date column as needed
+    tasks_df = tasks_df.sort_values(by='Actual End', ascending=True)
+
+    return deals_df, tasks_df
+
+# Function to clean the Appointments export
+def normalize_appointments(appointments_df):
+    appointments_df = appointments_df.copy()
+
+    # Clean 'Description' field in appointments
+    if 'Description' in appointments_df.columns:
+        appointments_df['Description'] = appointments_df['Description'].apply(strip_html)
+
+    # Drop unwanted columns from appointments
+    appointments_df = appointments_df.drop(columns=['Appointment', 'Row Checksum', '(Do Not Modify) Modified On'], errors='ignore')
+
+    # Convert the time fields to datetime and format the dates as mm/dd/yyyy
+    date_columns = [col for col in ['Modified On', 'Start Time', 'End Time'] if col in appointments_df.columns]
+    appointments_df[date_columns] = appointments_df[date_columns].apply(lambda x: pd.to_datetime(x, errors='coerce').dt.strftime('%m/%d/%Y'))
+
+    return appointments_df
+
+# Uploads larger than this are streamed row by row instead of being parsed into one frame
+STREAMING_EXPORT_BYTES = 25 * 1024 * 1024
+STREAMING_CHUNK_ROWS = 50000
+
+# Function to normalize one chunk of rows read from an export
+def normalize_export_chunk(role, chunk):
+    if role == 'appointments':
+        return normalize_appointments(chunk)
+    return (
+        normalize_deals(drop_duplicate_rows(chunk, DEAL_COLUMNS)),
+        normalize_tasks(drop_duplicate_rows(chunk, TASK_COLUMNS + ['Regarding']))
+    )
+
+# Function to read a large export row by row with openpyxl, normalizing one chunk of rows at a time.
+# Only the used columns are kept, and each chunk is de-duplicated and typed before the next is read,
+# so the export never exists as one wide object frame.
+def stream_export(file_contents, file_label, report_rows=None):
+    from openpyxl import load_workbook
+    report_rows = report_rows or (lambda row_count: None)
 
-if uploaded_files and len(uploaded_files) == 2:
+    workbook = load_workbook(BytesIO(file_contents), read_only=True, data_only=True)
     try:
-        # Initialize Excel writer
-        buffer = BytesIO()
-        with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-            current_row = 0  # Initialize starting row for Excel
-
-            # Read the uploaded files into dataframes
-            df1 = pd.read_excel(uploaded_files[0])
-            df2 = pd.read_excel(uploaded_files[1])
-
-            # Clean the column names
-            df1.columns = clean_column_names(df1.columns)
-            df2.columns = clean_column_names(df2.columns)
-
-            # Identify which dataframe is appointments based on specific columns
-            if {'Subject', 'Start Time'}.issubset(df1.columns):
-                appointments_df = df1.copy()
-                deals_tasks_df = df2.copy()
-            elif {'Subject', 'Start Time'}.issubset(df2.columns):
-                appointments_df = df2.copy()
-                deals_tasks_df = df1.copy()
+        worksheet = workbook.worksheets[0]
+        header = next(worksheet.iter_rows(max_row=1, values_only=True), ())
+        schema = resolve_schema(tuple(f"Unnamed: {i}" if col is None else str(col) for i, col in enumerate(header)))
+        if schema['missing']:
+            raise ValueError(f"{file_label} is missing required columns: {', '.join(schema['missing'])}")
+
+        # Rows are padded to the header width, so every projected position exists
+        project = operator.itemgetter(*schema['positions'])
+        rows = worksheet.iter_rows(min_row=2, max_col=len(header), values_only=True)
+        chunks = []
+        row_count = 0
+        while True:
+            chunk_rows = [project(row) for row in itertools.islice(rows, STREAMING_CHUNK_ROWS)]
+            if not chunk_rows and chunks:
+                break
+            chunk = pd.DataFrame.from_records(chunk_rows, columns=list(schema['columns']))
+            for col in schema['missing_optional']:
+                chunk[col] = OPTIONAL_COLUMN_FILLS[col]  # Ensure the column exists to avoid errors
+            chunks.append(normalize_export_chunk(schema['role'], chunk))
+            row_count += len(chunk_rows)
+            report_rows(row_count)
+            if not chunk_rows:
+                break
+    finally:
+        workbook.close()
+
+    if schema['role'] == 'appointments':
+        return schema['role'], pd.concat(chunks, ignore_index=True)
+
+    # A deal spans chunk boundaries, so the chunks are de-duplicated again once combined
+    deals_df = drop_duplicate_rows(pd.concat([deals for deals, _ in chunks], ignore_index=True)).reset_index(drop=True)
+    tasks_df = drop_duplicate_rows(pd.concat([tasks for _, tasks in chunks], ignore_index=True)).reset_index(drop=True)
+    return schema['role'], (deals_df, tasks_df.sort_values(by='Actual End', ascending=True))
+
+# Function to read and normalize one uploaded export, streaming it when it is large.
+# Returns its role with the (deals, tasks) frames of a Deals/Tasks export or the appointments frame.
+def load_export(file_contents, file_label, report_rows=None):
+    if len(file_contents) >= STREAMING_EXPORT_BYTES:
+        return stream_export(file_contents, file_label, report_rows)
+
+    role, df = read_export(file_contents, file_label)
+    if role == 'appointments':
+        return role, normalize_appointments(df)
+    return role, normalize_deals_tasks(df)
+
+# Day counts derived from the deal dates: column -> (date column, +1 for days until the date, -1 for days since)
+DERIVED_DAY_COLUMNS = {
+    'Days to IP Expiration': ('IP Expiration Date', 1),
+    'Days to First Closing': ('Projected Deal First Closing Date', 1),
+    'Days Since GF Submittal': ('GF Submittal Date', -1)
+}
+
+# Function to recompute the day-count columns of the deals against an as-of date (today by default).
+# Exported day counts go stale the day after the export; missing dates stay missing.
+def add_derived_day_columns(deals_df, as_of_date=None):
+    if as_of_date is None:
+        as_of_date = pd.Timestamp(datetime.now().date())
+    return deals_df.assign(**{
+        col: ((deals_df[date_col] - as_of_date).dt.days * direction).astype('Int64')
+        for col, (date_col, direction) in DERIVED_DAY_COLUMNS.items()
+    })
+
+# Low-cardinality string columns stored as categoricals to save memory
+CATEGORICAL_COLUMNS = [
+    'Regarding', 'Sub-Market', 'Calculated Deal Stage', 'Status Reason',
+    'Owner', 'Task Category', 'Acquisition Type', 'Product Type Description'
+]
+
+# Function to convert repeated string columns to categoricals with one shared category dictionary per column
+def apply_shared_categories(*frames):
+    shared_dtypes = {}
+    for col in CATEGORICAL_COLUMNS:
+        values = [pd.Index(df[col].dropna().unique()) for df in frames if col in df.columns]
+        if not values:
+            continue
+        categories = values[0].append(values[1:]).unique()
+        try:
+            categories = categories.sort_values()  # Keep sorting by a categorical column alphabetical
+        except TypeError:
+            pass
+        shared_dtypes[col] = pd.CategoricalDtype(categories)
+
+    # The same dtype object is used in every frame, so equality filters and joins compare integer codes
+    converted_frames = []
+    for df in frames:
+        df = df.copy()
+        for col, dtype in shared_dtypes.items():
+            if col in df.columns:
+                df[col] = df[col].astype(dtype)
+        converted_frames.append(df)
+    return converted_frames
+
+# Function to group tasks and appointments by deal, with the task counts per status
+def build_deal_groups(tasks_df, appointments_df):
+    deal_groups = {}
+    for deal_name, deal_tasks in tasks_df.groupby('Regarding', sort=False, observed=True):
+        deal_groups[deal_name] = {'tasks': deal_tasks, 'appointments': appointments_df.iloc[0:0]}
+    for deal_name, deal_appointments in appointments_df.groupby('Regarding', sort=False, observed=True):
+        deal_groups.setdefault(deal_name, {'tasks': tasks_df.iloc[0:0]})['appointments'] = deal_appointments
+
+    # Count the number of tasks per status once, instead of on every render
+    for group in deal_groups.values():
+        status_counts = group['tasks']['Status Reason'].value_counts()
+        group['counts'] = {
+            'Show All': len(group['tasks']),
+            'In Progress': int(status_counts.get('In Progress', 0)),
+            'Completed': int(status_counts.get('Completed', 0)),
+            'Not Started': int(status_counts.get('Not Started', 0))
+        }
+    return deal_groups
+
+# Function to return the group for a deal, or an empty group if the deal has no tasks or appointments
+def get_deal_group(deal_groups, deal_name, tasks_df, appointments_df):
+    if deal_name in deal_groups:
+        return deal_groups[deal_name]
+    return {
+        'tasks': tasks_df.iloc[0:0],
+        'appointments': appointments_df.iloc[0:0],
+        'counts': {'Show All': 0, 'In Progress': 0, 'Completed': 0, 'Not Started': 0}
+    }
+
+# Trailing words ignored when comparing deal names between exports
+DEAL_NAME_SUFFIXES = {'llc', 'inc', 'lp', 'llp', 'ltd', 'co', 'corp', 'company'}
+
+# Fuzzy matches scoring below this confidence are left unmatched
+FUZZY_MATCH_THRESHOLD = 0.8
+
+# Function to normalize a deal name for matching: case, punctuation, whitespace and company suffixes
+def normalize_deal_key(name):
+    words = re.sub(r'[^0-9a-z]+', ' ', str(name).casefold()).split()
+    while words and words[-1] in DEAL_NAME_SUFFIXES:
+        words.pop()
+    return ' '.join(words)
+
+# Function to split a normalized deal name into character trigrams
+def deal_key_trigrams(deal_key):
+    padded = f"  {deal_key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+# Function to map appointment 'Regarding' names to deal names.
+# Names are matched exactly, then on their normalized key, then by a blocked trigram search:
+# only deals sharing a distinctive trigram with the name are scored, so the cost grows with
+# the number of candidates instead of with deals x appointment names.
+def match_deal_names(deal_names, names_to_match):
+    deal_names = pd.Index(deal_names).dropna().unique()
+    deal_keys = [normalize_deal_key(deal_name) for deal_name in deal_names]
+
+    deals_by_key = {}
+    for deal_name, deal_key in zip(deal_names, deal_keys):
+        deals_by_key.setdefault(deal_key, []).append(deal_name)
+
+    # Inverted index from trigram to deals, leaving out trigrams shared by too many deals to narrow anything down
+    deal_trigrams = [deal_key_trigrams(deal_key) for deal_key in deal_keys]
+    deals_by_trigram = {}
+    for deal_index, trigrams in enumerate(deal_trigrams):
+        for trigram in trigrams:
+            deals_by_trigram.setdefault(trigram, []).append(deal_index)
+    max_postings = max(10, len(deal_names) // 5)
+
+    matches = []
+    for name in pd.Index(names_to_match).dropna().unique():
+        if name in deal_names:
+            matches.append((name, name, 'Exact', 1.0))
+            continue
+
+        name_key = normalize_deal_key(name)
+        if len(deals_by_key.get(name_key, [])) == 1:
+            matches.append((name, deals_by_key[name_key][0], 'Normalized', 0.95))
+            continue
+
+        name_trigrams = deal_key_trigrams(name_key)
+        candidates = {}
+        for trigram in name_trigrams:
+            postings = deals_by_trigram.get(trigram, [])
+            if len(postings) <= max_postings:
+                for deal_index in postings:
+                    candidates[deal_index] = candidates.get(deal_index, 0) + 1
+
+        # Score the best candidates with the Dice coefficient over their trigram sets.
+        # Numbers (phase, section, parcel) tell deals apart, so they have to agree exactly.
+        name_numbers = set(re.findall(r'\d+', name_key))
+        best_match, best_score = None, 0.0
+        for deal_index in sorted(candidates, key=candidates.get, reverse=True)[:10]:
+            if set(re.findall(r'\d+', deal_keys[deal_index])) != name_numbers:
+                continue
+            shared = len(name_trigrams & deal_trigrams[deal_index])
+            score = 2 * shared / (len(name_trigrams) + len(deal_trigrams[deal_index]))
+            if score > best_score:
+                best_match, best_score = deal_names[deal_index], score
+
+        if best_score >= FUZZY_MATCH_THRESHOLD:
+            matches.append((name, best_match, 'Fuzzy', round(best_score, 2)))
+        else:
+            matches.append((name, None, 'Unmatched', round(best_score, 2)))
+
+    return pd.DataFrame(matches, columns=['Appointment Regarding', 'Matched Deal', 'Match Method', 'Match Confidence'])
+
+# Function to join appointments to deals, rewriting 'Regarding' to the matched deal name.
+# Returns the appointments and a report of the names that did not match exactly.
+def join_appointments_to_deals(deals_df, appointments_df):
+    name_matches = match_deal_names(deals_df['Regarding'], appointments_df['Regarding'])
+    match_report = name_matches[name_matches['Match Method'] != 'Exact'].reset_index(drop=True)
+    match_report['Appointments'] = match_report['Appointment Regarding'].map(appointments_df['Regarding'].value_counts())
+
+    # One lookup per appointment; names without a match keep their own value
+    matched = match_report.dropna(subset=['Matched Deal'])
+    regarding = appointments_df['Regarding'].astype(object)
+    appointments_df = appointments_df.assign(
+        Regarding=regarding.map(dict(zip(matched['Appointment Regarding'], matched['Matched Deal']))).fillna(regarding)
+    )
+    return appointments_df, match_report
+
+# Function to upsert rows from a delta frame, keeping the most recently modified row per key
+def upsert_by_modified_on(snapshot_df, delta_df, key_columns):
+    modified_on = pd.to_datetime(delta_df['Modified On'], format='%m/%d/%Y', errors='coerce')
+
+    # Within the delta, keep the most recently modified row per key; stable, so on equal 'Modified On' the last row wins
+    order = modified_on.reset_index(drop=True).sort_values(kind='stable', na_position='first').index
+    delta_df = delta_df.reset_index(drop=True).loc[order].drop_duplicates(subset=key_columns, keep='last').sort_index()
+    return replace_rows_by_key(snapshot_df, delta_df, key_columns)
+
+# Function to replace the snapshot rows whose key appears in the delta by the delta rows.
+# Snapshot rows with other keys are kept as they are, even when they share a key among themselves.
+def replace_rows_by_key(snapshot_df, delta_df, key_columns):
+    snapshot_keys = pd.MultiIndex.from_frame(snapshot_df[key_columns].astype(object))
+    delta_keys = pd.MultiIndex.from_frame(delta_df[key_columns].astype(object))
+    return pd.concat([snapshot_df[~snapshot_keys.isin(delta_keys)], delta_df], ignore_index=True)
+
+# Function to merge the normalized frames of a delta export into a previously normalized snapshot
+def merge_delta_exports(snapshot, delta_deals_tasks, delta_appointments_df):
+    deals_df = snapshot['Deals']
+    tasks_df = snapshot['Tasks']
+    appointments_df = snapshot['Appointments']
+    affected_deals = set()
+    match_report = pd.DataFrame(columns=['Appointment Regarding', 'Matched Deal', 'Match Method', 'Match Confidence', 'Appointments'])
+
+    if delta_deals_tasks is not None:
+        delta_deals_df, delta_tasks_df = delta_deals_tasks
+        affected_deals.update(delta_deals_df['Regarding'].dropna())
+
+        # Changed deals replace their previous attributes, new deals are appended
+        deals_df = pd.concat([
+            deals_df[~deals_df['Regarding'].isin(delta_deals_df['Regarding'])],
+            delta_deals_df
+        ], ignore_index=True)
+        tasks_df = upsert_by_modified_on(tasks_df, delta_tasks_df, TASK_KEY_COLUMNS).sort_values(by='Actual End', ascending=True)
+
+    if delta_appointments_df is not None:
+        delta_appointments_df, match_report = join_appointments_to_deals(deals_df, delta_appointments_df)
+        affected_deals.update(delta_appointments_df['Regarding'].dropna())
+        if 'Modified On' in delta_appointments_df.columns:
+            appointments_df = upsert_by_modified_on(appointments_df, delta_appointments_df, APPOINTMENT_KEY_COLUMNS)
+        else:
+            appointments_df = replace_rows_by_key(
+                appointments_df, delta_appointments_df.drop_duplicates(subset=APPOINTMENT_KEY_COLUMNS, keep='last'), APPOINTMENT_KEY_COLUMNS
+            )
+
+    # Concatenating frames with different categories falls back to object, so share the categories again
+    deals_df, tasks_df, appointments_df = apply_shared_categories(deals_df, tasks_df, appointments_df)
+
+    # The merged frames are relabeled, so every deal is grouped again from them; groups taken from the
+    # snapshot would point the urgency buckets, which are aligned on the row labels, at other rows
+    deal_groups = build_deal_groups(tasks_df, appointments_df)
+
+    return deals_df, tasks_df, appointments_df, deal_groups, affected_deals, match_report
+
+# Function to read a normalized snapshot workbook written by the download button
+def read_snapshot(snapshot_file):
+    sheets = pd.read_excel(snapshot_file, sheet_name=['Deals', 'Tasks', 'Appointments'])
+    sheets['Deals']['Days to IP Expiration'] = pd.to_numeric(sheets['Deals']['Days to IP Expiration'], errors='coerce').round().astype('Int64')
+    sheets['Deals'][DEAL_DATE_COLUMNS] = sheets['Deals'][DEAL_DATE_COLUMNS].apply(lambda x: pd.to_datetime(x, errors='coerce').dt.normalize())
+    return sheets
+
+# Function to write the normalized frames to a snapshot workbook for the next incremental refresh
+def write_snapshot(deals_df, tasks_df, appointments_df):
+    snapshot_buffer = BytesIO()
+    with pd.ExcelWriter(snapshot_buffer, engine='xlsxwriter') as snapshot_writer:
+        deals_df.to_excel(snapshot_writer, sheet_name='Deals', index=False)
+        tasks_df.to_excel(snapshot_writer, sheet_name='Tasks', index=False)
+        appointments_df.to_excel(snapshot_writer, sheet_name='Appointments', index=False)
+    return snapshot_buffer.getvalue()
+
+# Function to write the deals being shown, each followed by its tasks and appointments, to the download workbook.
+# It runs only when a download is requested, so xlsxwriter is not imported or filled on every rerun.
+def build_excel_export(deals_df, dataset, as_of_date):
+    buffer = BytesIO()
+    with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
+        current_row = 0  # Initialize starting row for Excel
+
+        if deals_df.empty:
+            deals_df.to_excel(writer, startrow=current_row, index=False, header=True, sheet_name='Data')
+
+        for _, deal in deals_df.iterrows():
+            # Write Deal Data to Excel
+            deal_data = deal.to_frame().T
+            deal_data.to_excel(writer, startrow=current_row, index=False, header=True, sheet_name='Data')
+            current_row += len(deal_data) + 2  # Adjust row position
+
+            deal_group = get_deal_group(dataset['groups'], deal['Regarding'], dataset['tasks'], dataset['appointments'])
+            urgency = get_group_urgency(dataset, deal_group, as_of_date)
+
+            # Write Tasks Data to Excel
+            related_tasks = with_urgency(deal_group['tasks'].drop(columns=['Regarding']), urgency['tasks'])
+            if not related_tasks.empty:
+                with_urgency_labels(related_tasks, TASK_URGENCY_LABELS).to_excel(writer, startrow=current_row, index=False, header=True, sheet_name='Data')
+                current_row += len(related_tasks) + 2
             else:
-                st.error("Could not identify the Appointments file. Please ensure it contains 'Subject' and 'Start Time' columns.")
-                st.stop()
-
-            # Nice to show the cleaned columns. Debug statement written at top of screen. 
-            # Debugging: Print the cleaned columns to verify "Actual Contract Execution Date" exists
-            # st.write("Cleaned columns in deals_tasks_df:", deals_tasks_df.columns)
-
-            # Clean 'Description' field in appointments
-            if 'Description' in appointments_df.columns:
-                appointments_df['Description'] = appointments_df['Description'].apply(strip_html)
-
-            # Drop unwanted columns from appointments
-            appointments_df = appointments_df.drop(columns=['Appointment', 'Row Checksum', '(Do Not Modify) Modified On'], errors='ignore')
-
-            # Define expected columns (after cleaning)
-            deal_columns = [
-                'Regarding', 'Sub-Market', 'Calculated Deal Stage',
-                'GF Submittal Date', 'Green Folder Meeting Date',
-                'IP Expiration Date', 'Days to IP Expiration',
-                'Projected Deal First Closing Date', 'Deal Homesite Total',
-                'Homesite Size Description', 'Acquisition Type',
-                'Primary Seller Company', 'Product Type Description',
-                'CIC Final Approval Date', 'Actual Contract Execution Date'
-            ]
-
-            task_columns = [
-                'Subject', 'Owner', 'Start Date', 'Due Date', 'Actual End',
-                'Status Reason', 'Vendor Assigned', 'Task Category', 
-                'Modified On', 'Comment'  
-            ]
-
-            # Extract deals data
-            deals_df = deals_tasks_df[deal_columns].drop_duplicates().reset_index(drop=True)
-
-            # Debug statement for sample data - written at top of screen
-            # Ensure "Actual Contract Execution Date" is loaded
-            # st.write("Sample of deals_df (checking for 'Actual Contract Execution Date'):", deals_df.head())
-
-            # Handle non-finite values in 'Days to IP Expiration'
-            deals_df['Days to IP Expiration'] = deals_df['Days to IP Expiration'].fillna(0).round().astype(int)
-            
-            # Convert date fields to datetime and extract only the date
-            date_columns = ['GF Submittal Date', 'Green Folder Meeting Date', 'IP Expiration Date', 'Projected Deal First Closing Date', 'CIC Final Approval Date', 'Actual Contract Execution Date']
-            #deals_df[date_columns] = deals_df[date_columns].apply(lambda x: pd.to_datetime(x, errors='coerce').dt.strftime('%m/%d/%Y'))
-            # Convert all date columns and remove time component
-            for col in date_columns:
-                deals_df[col] = pd.to_datetime(deals_df[col], errors='coerce').dt.strftime('%m/%d/%Y')
+                current_row += 2  # Add spacing even if no tasks
+
+            # Write Appointments Data to Excel
+            related_appointments = with_urgency(deal_group['appointments'].drop(columns=['Regarding']), urgency['appointments'])
+            if not related_appointments.empty:
+                with_urgency_labels(related_appointments, APPOINTMENT_URGENCY_LABELS).to_excel(writer, startrow=current_row, index=False, header=True, sheet_name='Data')
+                current_row += len(related_appointments) + 2
+            else:
+                current_row += 2  # Add spacing even if no appointments
+
+            current_row += 1  # Extra space between deals
+
+        # Adjust column widths for better readability
+        worksheet = writer.sheets['Data']
+        for i in range(max(len(DEAL_COLUMNS), len(TASK_COLUMNS), len(APPOINTMENT_COLUMNS))):
+            worksheet.set_column(i, i, 20)
+    return buffer.getvalue()
+
+
+
+# Function to parse and normalize the uploaded exports.
+# The returned frames are shared across sessions and must be treated as read-only.
+def load_exports(load_mode, export_files, snapshot_contents=None, report_progress=None):
+    # Progress is reported between stages; a cancelled run stops at the next report
+    report_progress = report_progress or (lambda fraction, stage: None)
+
+    # Read and normalize the uploaded files, resolving each header to the canonical columns
+    role_frames = []
+    for i, file_contents in enumerate(export_files):
+        stage = f"Reading uploaded file {i + 1} of {len(export_files)}"
+        report_progress(0.55 * i / len(export_files), stage)
+        role_frames.append(load_export(
+            file_contents, f"Uploaded file {i + 1}",
+            lambda row_count: report_progress(0.55 * i / len(export_files), f"{stage} ({row_count:,} rows)")
+        ))
+
+    # Identify which export is appointments based on the resolved schema
+    deals_tasks, appointments_df = split_export_frames(role_frames)
+
+    if load_mode == "Full export":
+        if deals_tasks is None or appointments_df is None:
+            raise ValueError("Could not identify the Appointments file. Please ensure it contains 'Subject' and 'Start Time' columns.")
+
+        deals_df, tasks_df = deals_tasks
+        report_progress(0.55, "Matching appointments to deals")
+        appointments_df, match_report = join_appointments_to_deals(deals_df, appointments_df)
+        report_progress(0.7, "Grouping tasks and appointments by deal")
+        deals_df, tasks_df, appointments_df = apply_shared_categories(deals_df, tasks_df, appointments_df)
+        deal_groups = build_deal_groups(tasks_df, appointments_df)
+        affected_deals = set()
+    else:
+        # Upsert the changed rows into the previous snapshot, then group the merged frames by deal
+        report_progress(0.4, "Reading the previous snapshot")
+        snapshot = read_snapshot(BytesIO(snapshot_contents))
+        report_progress(0.6, "Merging the delta export")
+        deals_df, tasks_df, appointments_df, deal_groups, affected_deals, match_report = merge_delta_exports(
+            snapshot, deals_tasks, appointments_df
+        )
 
-            # Other code for tasks, appointments, and filtering...
+    report_progress(0.85, "Indexing deals for filtering, sorting and search")
+    return build_dataset(deals_df, tasks_df, appointments_df, deal_groups, affected_deals, match_report)
+
+# Function to assemble a dataset from its normalized frames, with the indexes built once per dataset.
+# A dataset served from the local database has no task or appointment rows in memory; its filters,
+# search and per-deal reads are answered by the database instead.
+def build_dataset(deals_df, tasks_df, appointments_df, deal_groups, affected_deals, match_report, database=None):
+    return {
+        'deals': deals_df,
+        'tasks': tasks_df,
+        'appointments': appointments_df,
+        'groups': deal_groups,
+        'affected_deals': affected_deals,
+        'match_report': match_report,
+        'database': database,
+        'filter_masks': build_database_filter_masks(database) if database else build_deal_filter_masks(deals_df),
+        'sort_permutations': build_sort_permutations(deals_df),
+        'search_index': {'database': database} if database else build_search_index(deals_df, tasks_df, appointments_df),
+        'derived': OrderedDict(),  # Results computed from this dataset on demand, see get_derived
+        'task_views': OrderedDict(),  # Filtered task views of single deals, kept apart so they cannot evict the results above
+        'derived_lock': threading.Lock()
+    }
 
-            appointment_columns = [
-                'Subject', 'Regarding', 'Owner', 'Status', 'Start Time',
-                'End Time', 'Category', 'Description' 
-            ]
+# Derived results kept per dataset; the least recently used are dropped first,
+# e.g. when users flip through many as-of dates
+DERIVED_CACHE_SIZE = 64
+TASK_VIEW_CACHE_SIZE = 1024
+
+# Function to memoize a result computed from a shared dataset, so every session reuses it.
+# Keys include the as-of date for date-dependent results, so each date is computed once.
+def get_derived(dataset, key, compute, cache='derived', max_size=DERIVED_CACHE_SIZE):
+    derived = dataset[cache]
+    with dataset['derived_lock']:
+        if key in derived:
+            derived.move_to_end(key)
+            return derived[key]
+
+    value = compute()
+    with dataset['derived_lock']:
+        derived[key] = value
+        while len(derived) > max_size:
+            derived.popitem(last=False)
+    return value
+
+# Function to return the urgency of the dataset's tasks and appointments, computed once per day
+def get_urgency(dataset, as_of_date):
+    return get_derived(dataset, ('urgency', as_of_date), lambda: compute_urgency(dataset['tasks'], dataset['appointments'], as_of_date))
+
+# Function to return the urgency buckets covering a deal's tasks and appointments.
+# Database-backed datasets compute them from the deal's rows, as the other rows are not in memory.
+def get_group_urgency(dataset, deal_group, as_of_date):
+    if dataset['database']:
+        return compute_urgency(deal_group['tasks'], deal_group['appointments'], as_of_date)
+    return get_urgency(dataset, as_of_date)
+
+# Function to return the deals with their day counts recomputed for a date
+def get_deals_as_of(dataset, as_of_date):
+    return get_derived(dataset, ('deals', as_of_date), lambda: add_derived_day_columns(dataset['deals'], as_of_date))
+
+# Windows for the upcoming IP expirations of the portfolio summary
+IP_EXPIRATION_WINDOWS = [(30, 'Within 30 days'), (60, 'In 31-60 days'), (90, 'In 61-90 days')]
+
+# Label of the overdue tasks with no Owner or no Sub-Market (including tasks of unknown deals) in the summary
+UNASSIGNED_LABEL = '(Unassigned)'
+
+# Function to compute the portfolio summary with one grouped aggregation per table,
+# from deals whose day counts were derived for the summary date
+def compute_portfolio_kpis(deals_df, overdue_counts):
+    # Overdue tasks by Owner and Sub-Market, from the counts per (Owner, Regarding);
+    # missing values are labeled so the table adds up to the overdue task count
+    deal_sub_markets = deals_df.drop_duplicates('Regarding').set_index('Regarding')['Sub-Market']
+    overdue_by_owner = (
+        overdue_counts.assign(**{
+            'Owner': overdue_counts['Owner'].astype(object).fillna(UNASSIGNED_LABEL),
+            'Sub-Market': overdue_counts['Regarding'].map(deal_sub_markets).astype(object).fillna(UNASSIGNED_LABEL)
+        })
+        .groupby(['Owner', 'Sub-Market'])['Tasks'].sum()
+        .unstack(fill_value=0)
+    )
+    if not overdue_by_owner.empty:
+        overdue_by_owner['Total'] = overdue_by_owner.sum(axis=1)
 
-            # Extract deals data
-            deals_df = deals_tasks_df[deal_columns].drop_duplicates().reset_index(drop=True)
+    # Deals and homesites by Calculated Deal Stage
+    homesites_by_stage = deals_df.groupby('Calculated Deal Stage', observed=True).agg(
+        Deals=('Regarding', 'size'),
+        Homesites=('Deal Homesite Total', 'sum')
+    )
 
-            # Handle non-finite values in 'Days to IP Expiration'
-            deals_df['Days to IP Expiration'] = deals_df['Days to IP Expiration'].fillna(0).round().astype(int)
+    # Deals whose IP expires within the next 30/60/90 days
+    days_to_expiration = deals_df['Days to IP Expiration']
+    expiration_window = pd.cut(
+        days_to_expiration,
+        bins=[-1] + [days for days, _ in IP_EXPIRATION_WINDOWS],
+        labels=[label for _, label in IP_EXPIRATION_WINDOWS]
+    )
+    upcoming_expirations = (
+        deals_df.assign(**{'Expires': expiration_window, 'Days Left': days_to_expiration})
+        .dropna(subset=['Expires'])
+        [['Expires', 'Days Left', 'Regarding', 'Sub-Market', 'IP Expiration Date', 'Deal Homesite Total']]
+        .sort_values(by='Days Left')
+    )
+    expirations_by_window = upcoming_expirations.groupby('Expires', observed=False).agg(
+        Deals=('Regarding', 'size'),
+        Homesites=('Deal Homesite Total', 'sum')
+    )
+
+    return {
+        'overdue_task_count': int(overdue_counts['Tasks'].sum()),
+        'overdue_by_owner': overdue_by_owner,
+        'homesites_by_stage': homesites_by_stage,
+        'expirations_by_window': expirations_by_window,
+        'upcoming_expirations': format_dates_for_display(upcoming_expirations, ['IP Expiration Date'])
+    }
+
+# Function to count the overdue tasks per (Owner, Regarding), from the task urgency buckets
+def count_overdue_tasks(tasks_df, task_urgency):
+    overdue_tasks = tasks_df.loc[task_urgency.reindex(tasks_df.index).to_numpy() == URGENCY_OVERDUE, ['Owner', 'Regarding']]
+    return overdue_tasks.astype(object).groupby(['Owner', 'Regarding'], dropna=False).size().reset_index(name='Tasks')
+
+# Function to return the portfolio summary of the dataset, computed once per day
+def get_portfolio_kpis(dataset, as_of_date):
+    def compute():
+        if dataset['database']:
+            overdue_counts = count_overdue_tasks_in_database(dataset['database'], as_of_date)
+        else:
+            overdue_counts = count_overdue_tasks(dataset['tasks'], get_urgency(dataset, as_of_date)['tasks'])
+        return compute_portfolio_kpis(get_deals_as_of(dataset, as_of_date), overdue_counts)
+    return get_derived(dataset, ('portfolio_kpis', as_of_date), compute)
+
+# Function to render the portfolio summary at the top of the page
+def render_portfolio_summary(portfolio_kpis):
+    with st.expander("Portfolio Summary", expanded=True):
+        expirations = portfolio_kpis['expirations_by_window']['Deals']
+        metric_cols = st.columns(2 + len(IP_EXPIRATION_WINDOWS))
+        metric_cols[0].metric("Overdue Tasks", portfolio_kpis['overdue_task_count'])
+        metric_cols[1].metric("Homesites", int(portfolio_kpis['homesites_by_stage']['Homesites'].sum()))
+        for metric_col, (_, label) in zip(metric_cols[2:], IP_EXPIRATION_WINDOWS):
+            metric_col.metric(f"IP Expiring {label.lower()}", int(expirations.get(label, 0)))
+
+        col1, col2 = st.columns(2)
+        with col1:
+            st.markdown("**Overdue Tasks by Owner and Sub-Market**")
+            if portfolio_kpis['overdue_by_owner'].empty:
+                st.write("No overdue tasks.")
+            else:
+                st.dataframe(portfolio_kpis['overdue_by_owner'])
+        with col2:
+            st.markdown("**Homesites by Calculated Deal Stage**")
+            st.dataframe(portfolio_kpis['homesites_by_stage'])
+
+        st.markdown("**Upcoming IP Expirations (next 90 days)**")
+        st.dataframe(portfolio_kpis['expirations_by_window'])
+        if not portfolio_kpis['upcoming_expirations'].empty:
+            st.dataframe(portfolio_kpis['upcoming_expirations'], hide_index=True)
+
+# Date columns stored as mm/dd/yyyy text in the tasks and appointments, typed for SQL queries
+SQL_DATE_COLUMNS = {
+    'tasks': ['Start Date', 'Due Date', 'Actual End', 'Modified On'],
+    'appointments': ['Start Time', 'End Time', 'Modified On']
+}
+
+SQL_EXAMPLE_QUERY = """SELECT t."Owner", d."Sub-Market", count(*) AS "In Progress Tasks"
+FROM tasks t JOIN deals d USING ("Regarding")
+WHERE t."Status Reason" = 'In Progress' AND d."Calculated Deal Stage" IN ('LOI', 'Not under LOI')
+GROUP BY ALL
+ORDER BY 3 DESC"""
+
+# Function to type the mm/dd/yyyy text dates of the dataset's frames for SQL queries, with rows numbered from 0
+def get_sql_frames(dataset):
+    frames = {table: dataset[table].reset_index(drop=True) for table in ['deals', 'tasks', 'appointments']}
+    for table, date_columns in SQL_DATE_COLUMNS.items():
+        frames[table] = frames[table].assign(**{
+            col: pd.to_datetime(frames[table][col], format='%m/%d/%Y', errors='coerce')
+            for col in date_columns if col in frames[table].columns
+        })
+    return frames
+
+# Function to return the columns of the SQL tables that depend on the as-of date, row for row with get_sql_frames.
+# They come from the urgency buckets and day counts cached per date, so a new date adds no copy of the tables.
+def get_sql_date_columns(dataset, as_of_date):
+    urgency = get_urgency(dataset, as_of_date)
+    return {
+        'deals': get_deals_as_of(dataset, as_of_date)[list(DERIVED_DAY_COLUMNS)].reset_index(drop=True),
+        'tasks': pd.DataFrame({'Urgency': urgency['tasks'].reindex(dataset['tasks'].index, fill_value=URGENCY_NONE).to_numpy()}),
+        'appointments': pd.DataFrame({'Urgency': urgency['appointments'].reindex(dataset['appointments'].index, fill_value=URGENCY_NONE).to_numpy()})
+    }
+
+# Function to convert the dataset's frames to Arrow tables for the SQL engine, once per dataset
+def get_sql_base_tables(dataset):
+    def compute():
+        import pyarrow as pa
+        return {table: pa.Table.from_pandas(df, preserve_index=False) for table, df in get_sql_frames(dataset).items()}
+    return get_derived(dataset, ('sql_tables',), compute)
+
+# Function to return the Arrow tables of a query on a date: the base tables with the date's columns set or appended.
+# Arrow tables share the columns they are built from, so only the date's columns are allocated.
+def get_sql_tables(dataset, as_of_date):
+    import pyarrow as pa
+    base_tables = get_sql_base_tables(dataset)
+    tables = {}
+    for table, date_columns_df in get_sql_date_columns(dataset, as_of_date).items():
+        arrow_table = base_tables[table]
+        for col in date_columns_df.columns:
+            column = pa.Array.from_pandas(date_columns_df[col])
+            if col in arrow_table.column_names:
+                arrow_table = arrow_table.set_column(arrow_table.column_names.index(col), col, column)
+            else:
+                arrow_table = arrow_table.append_column(col, column)
+        tables[table] = arrow_table
+    return tables
+
+# Function to import DuckDB on first use; it is optional, and without it SQL queries run on an in-memory SQLite copy of the data
+@functools.lru_cache(maxsize=None)
+def load_duckdb():
+    try:
+        import duckdb
+    except ImportError:
+        return None
+    return duckdb
+
+# DuckDB settings for user queries: no reading or writing of server files, URLs or extensions, and queries cannot re-enable them
+DUCKDB_QUERY_CONFIG = {'enable_external_access': False, 'lock_configuration': True}
+
+# SQLite actions allowed in user queries; anything else, such as ATTACH or writes, is denied
+SQLITE_QUERY_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+
+# Function to deny every SQLite action of a connection's later statements except reads
+def restrict_to_reads(connection):
+    connection.set_authorizer(lambda action, *args: sqlite3.SQLITE_OK if action in SQLITE_QUERY_ACTIONS else sqlite3.SQLITE_DENY)
+
+# Function to return an in-memory SQLite database of the dataset, used when DuckDB is not installed.
+# The frames are copied into "<table>_base" tables once per dataset; the deals, tasks and appointments
+# views join them on row_id to the columns of the as-of date last loaded by load_sqlite_date_columns.
+def get_sqlite_database(dataset):
+    def compute():
+        connection = sqlite3.connect(':memory:', check_same_thread=False)
+        columns = {}
+        for table, df in get_sql_frames(dataset).items():
+            df.to_sql(f"{table}_base", connection, index=True, index_label='row_id')
+            columns[table] = list(df.columns)
+        restrict_to_reads(connection)
+        return {'connection': connection, 'lock': threading.Lock(), 'columns': columns, 'as_of_date': None}
+    return get_derived(dataset, ('sqlite',), compute)
+
+# Function to load the columns of an as-of date into the SQLite database of a dataset, if another date is loaded.
+# Runs with the database lock held, and user queries only run once the read-only authorizer is back.
+def load_sqlite_date_columns(sqlite_database, dataset, as_of_date):
+    if sqlite_database['as_of_date'] == as_of_date:
+        return
+    connection = sqlite_database['connection']
+    connection.set_authorizer(None)
+    try:
+        for table, date_columns_df in get_sql_date_columns(dataset, as_of_date).items():
+            date_columns_df.to_sql(f"{table}_as_of", connection, if_exists='replace', index=True, index_label='row_id')
+            column_list = ', '.join(
+                [f'a."{col}"' if col in date_columns_df.columns else f'b."{col}"' for col in sqlite_database['columns'][table]]
+                + [f'a."{col}"' for col in date_columns_df.columns if col not in sqlite_database['columns'][table]]
+            )
+            connection.execute(f'DROP VIEW IF EXISTS {table}')
+            connection.execute(f'CREATE VIEW {table} AS SELECT {column_list} FROM {table}_base b JOIN {table}_as_of a USING (row_id)')
+        connection.commit()
+    finally:
+        restrict_to_reads(connection)
+    sqlite_database['as_of_date'] = as_of_date
+
+# Function to run a SQL query over the deals, tasks and appointments tables of a dataset.
+# With DuckDB the Arrow tables are scanned in place by its vectorized engine.
+def run_sql(dataset, sql, as_of_date=None):
+    if as_of_date is None:
+        as_of_date = pd.Timestamp(datetime.now().date())
+
+    # The local database is queried in place, read-only, instead of being copied into a query engine
+    if dataset['database']:
+        with closing(connect_database_read_only(dataset['database'])) as connection:
+            restrict_to_reads(connection)
+            return pd.read_sql_query(sql, connection)
+
+    duckdb = load_duckdb()
+    if duckdb is not None:
+        # A connection per query: registering Arrow tables copies nothing, and sessions never share a connection
+        with duckdb.connect(config=DUCKDB_QUERY_CONFIG) as connection:
+            for table, arrow_table in get_sql_tables(dataset, as_of_date).items():
+                connection.register(table, arrow_table)
+            return connection.execute(sql).df()
+
+    sqlite_database = get_sqlite_database(dataset)
+    with sqlite_database['lock']:
+        load_sqlite_date_columns(sqlite_database, dataset, as_of_date)
+        return pd.read_sql_query(sql, sqlite_database['connection'])
+
+# Function to render the SQL query box
+def render_sql_query(dataset, as_of_date):
+    with st.expander("SQL Query"):
+        # Only check that DuckDB is installed here; it is imported when a query runs
+        has_duckdb = importlib.util.find_spec('duckdb') is not None and not dataset['database']
+        engine = "DuckDB" if has_duckdb else "SQLite"
+        st.caption(f"Query the deals, tasks and appointments tables with {engine} SQL. Quote column names with spaces, e.g. \"Status Reason\".")
+        if dataset['database']:
+            st.caption("Dates in the local database are stored as YYYY-MM-DD text and there is no Urgency column.")
+        sql = st.text_area("Query:", value=SQL_EXAMPLE_QUERY if has_duckdb else "SELECT * FROM tasks LIMIT 100", height=150)
+        if st.button("Run Query"):
+            try:
+                st.dataframe(run_sql(dataset, sql, as_of_date), hide_index=True)
+            except Exception as e:
+                st.error(f"The query failed: {e}")
+
+# Local store of normalized snapshots, one Parquet partition per export date
+SNAPSHOT_STORE_DIR = Path(os.environ.get('DEAL_SNAPSHOT_DIR', 'snapshots'))
+SNAPSHOT_TABLES = ['deals', 'tasks', 'appointments']
+
+# Function to save the normalized frames of a dataset as the snapshot of an export date, replacing any earlier one
+def save_snapshot(dataset, export_date, store_dir=SNAPSHOT_STORE_DIR):
+    partition = f"export_date={export_date:%Y-%m-%d}"
+    frames = get_dataset_frames(dataset)
+    for table in SNAPSHOT_TABLES:
+        partition_dir = store_dir / table / partition
+        if partition_dir.exists():
+            shutil.rmtree(partition_dir)
+        partition_dir.mkdir(parents=True)
+        frames[table].to_parquet(partition_dir / 'part-0.parquet', index=False)
+
+# Function to list the export dates in the snapshot store from the partition names, without reading any data
+def list_snapshot_dates(store_dir=SNAPSHOT_STORE_DIR):
+    tasks_dir = store_dir / 'tasks'
+    if not tasks_dir.exists():
+        return []
+    return sorted(
+        (pd.Timestamp(partition.name.split('=', 1)[1]) for partition in tasks_dir.glob('export_date=*')),
+        reverse=True
+    )
+
+# Function to read only the given columns of one table for one export date
+def read_snapshot_table(table, export_date, columns, store_dir=SNAPSHOT_STORE_DIR):
+    return pd.read_parquet(store_dir / table / f"export_date={export_date:%Y-%m-%d}", columns=columns)
+
+# Function to compare the tasks of two snapshots on (Regarding, Subject).
+# Only the key, Due Date and Status Reason columns of the two partitions are read.
+def diff_snapshot_tasks(before_date, after_date, store_dir=SNAPSHOT_STORE_DIR):
+    columns = TASK_KEY_COLUMNS + ['Due Date', 'Status Reason']
+    before_df, after_df = [
+        read_snapshot_table('tasks', export_date, columns, store_dir)
+        .astype({col: object for col in TASK_KEY_COLUMNS + ['Status Reason']})  # Each snapshot has its own categories
+        .drop_duplicates(subset=TASK_KEY_COLUMNS, keep='last')
+        for export_date in [before_date, after_date]
+    ]
+    tasks = before_df.merge(after_df, on=TASK_KEY_COLUMNS, how='inner', suffixes=(' (Before)', ' (After)'))
+
+    due_before = pd.to_datetime(tasks['Due Date (Before)'], format='%m/%d/%Y', errors='coerce')
+    due_after = pd.to_datetime(tasks['Due Date (After)'], format='%m/%d/%Y', errors='coerce')
+    status_before = tasks['Status Reason (Before)'].fillna('')
+    status_after = tasks['Status Reason (After)'].fillna('')
+
+    slipped = tasks[(due_after > due_before).to_numpy()].assign(**{'Days Slipped': (due_after - due_before).dt.days})
+    return {
+        'slipped': slipped.sort_values(by='Days Slipped', ascending=False),
+        'status_changed': tasks[(status_before != status_after).to_numpy()],
+        'newly_completed': tasks[((status_after == 'Completed') & (status_before != 'Completed')).to_numpy()]
+    }
+
+# Function to render the snapshot store: saving the current dataset and comparing two export dates
+def render_snapshot_history(dataset, as_of_date):
+    with st.expander("Snapshot History"):
+        col1, col2 = st.columns([2, 1])
+        with col1:
+            export_date = st.date_input("Export date of the uploaded files:", value=as_of_date.date(), key="snapshot_export_date")
+        with col2:
+            if st.button("Save Snapshot"):
+                save_snapshot(dataset, pd.Timestamp(export_date))
+                st.success(f"Saved the snapshot for {export_date:%m/%d/%Y}.")
+
+        snapshot_dates = list_snapshot_dates()
+        if len(snapshot_dates) < 2:
+            st.write("Save snapshots of at least two export dates to compare them.")
+            return
+
+        col1, col2 = st.columns(2)
+        with col1:
+            before_date = st.selectbox("Compare from:", snapshot_dates[1:], format_func=lambda date: f"{date:%m/%d/%Y}")
+        with col2:
+            after_date = st.selectbox("Compare to:", snapshot_dates, format_func=lambda date: f"{date:%m/%d/%Y}")
+
+        task_changes = diff_snapshot_tasks(before_date, after_date)
+        st.markdown(f"**Tasks that slipped their Due Date ({len(task_changes['slipped'])})**")
+        st.dataframe(task_changes['slipped'], hide_index=True)
+        st.markdown(f"**Tasks that changed Status Reason ({len(task_changes['status_changed'])})**")
+        st.dataframe(task_changes['status_changed'], hide_index=True)
+        st.markdown(f"**Tasks newly completed ({len(task_changes['newly_completed'])})**")
+        st.dataframe(task_changes['newly_completed'], hide_index=True)
+
+# Datasets nobody has used for this long are evicted from the shared store
+DATASET_TTL_SECONDS = 60 * 60
+
+# Process-wide, read-only store of normalized datasets keyed by the content hash of the uploads.
+# Sessions that upload the same exports share one copy; each session holds a reference to the
+# dataset it is viewing, and datasets without live references are evicted after the TTL.
+class SharedDatasetStore:
+    def __init__(self, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = {}  # dataset key -> {'dataset', 'sessions': {session id: last seen}, 'last_used'}
+        self._loading_locks = {}
+
+    def acquire(self, dataset_key, session_id, loader):
+        with self._lock:
+            self._evict_expired()
+            loading_lock = self._loading_locks.setdefault(dataset_key, threading.Lock())
+
+        # Only one session parses a given dataset; the others wait and then share it
+        with loading_lock:
+            with self._lock:
+                entry = self._entries.get(dataset_key)
+            if entry is None:
+                entry = {'dataset': loader(), 'sessions': {}, 'last_used': time.monotonic()}
+
+        with self._lock:
+            entry = self._entries.setdefault(dataset_key, entry)
+            entry['sessions'][session_id] = entry['last_used'] = time.monotonic()
+            self._loading_locks.pop(dataset_key, None)
+            return entry['dataset']
+
+    def get(self, dataset_key, session_id):
+        with self._lock:
+            entry = self._entries.get(dataset_key)
+            if entry is None:
+                return None
+            entry['sessions'][session_id] = entry['last_used'] = time.monotonic()
+            return entry['dataset']
+
+    def release(self, dataset_key, session_id):
+        with self._lock:
+            entry = self._entries.get(dataset_key)
+            if entry is not None:
+                entry['sessions'].pop(session_id, None)
+                entry['last_used'] = time.monotonic()
+            self._evict_expired()
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        for dataset_key in list(self._entries):
+            entry = self._entries[dataset_key]
+            # Sessions that were closed without releasing stop counting once they go quiet
+            entry['sessions'] = {session_id: last_seen for session_id, last_seen in entry['sessions'].items() if now - last_seen < self.ttl_seconds}
+            if not entry['sessions'] and now - entry['last_used'] >= self.ttl_seconds:
+                del self._entries[dataset_key]
+
+# Function to return the one store shared by every session of this server process
+@st.cache_resource
+def get_dataset_store():
+    return SharedDatasetStore(DATASET_TTL_SECONDS)
+
+# Function to compute the content hash that identifies a set of uploads
+def compute_dataset_key(load_mode, export_files, snapshot_contents=None):
+    digest = hashlib.sha256(load_mode.encode())
+    for file_contents in sorted(hashlib.sha256(contents).digest() for contents in export_files):
+        digest.update(file_contents)  # Upload order does not change the dataset
+    if snapshot_contents is not None:
+        digest.update(b'snapshot')
+        digest.update(hashlib.sha256(snapshot_contents).digest())
+    return digest.hexdigest()
+
+# Raised inside a background ingestion run whose uploads have been replaced
+class IngestionCancelled(Exception):
+    pass
+
+# Background ingestion run for one set of uploads. The worker thread only updates the progress
+# fields; the script polls them, since Streamlit elements cannot be written from another thread.
+class IngestionJob:
+    def __init__(self, dataset_key):
+        self.dataset_key = dataset_key
+        self.fraction = 0.0
+        self.stage = "Waiting for a worker"
+        self.cancel_event = threading.Event()
+        self.future = None
+
+    def report_progress(self, fraction, stage):
+        if self.cancel_event.is_set():
+            raise IngestionCancelled()
+        self.fraction = fraction
+        self.stage = stage
+
+    def cancel(self):
+        self.cancel_event.set()
+        if self.future is not None:
+            self.future.cancel()  # Only succeeds if the run has not started yet
+
+# Function to return the worker pool that parses uploads for every session of this server process
+@st.cache_resource
+def get_ingestion_executor():
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="ingestion")
+
+# Function to cancel the background ingestion run of this session, if any
+def cancel_ingestion_job():
+    job = st.session_state.pop('ingestion_job', None)
+    if job is not None:
+        job.cancel()
+
+# Function to point this session at another dataset, dropping its reference to the one it was viewing
+def switch_session_dataset(store, session_id, dataset_key):
+    previous_key = st.session_state.get('dataset_key')
+    if previous_key is not None and previous_key != dataset_key:
+        store.release(previous_key, session_id)
+    st.session_state['dataset_key'] = dataset_key
+
+# Function to attach this session to the shared dataset for its uploads. Uploads no session has
+# parsed yet are processed in the background while this shows their progress and reruns to poll.
+def acquire_session_dataset(load_mode, uploaded_files, snapshot_file):
+    store = get_dataset_store()
+    session_id = get_script_run_ctx().session_id
+
+    # Hash the uploads only when they change, not on every rerun
+    upload_ids = (load_mode, tuple(uploaded_file.file_id for uploaded_file in uploaded_files), snapshot_file.file_id if snapshot_file is not None else None)
+    if st.session_state.get('upload_ids') != upload_ids:
+        export_files = tuple(uploaded_file.getvalue() for uploaded_file in uploaded_files)
+        snapshot_contents = snapshot_file.getvalue() if snapshot_file is not None else None
+        dataset_key = compute_dataset_key(load_mode, export_files, snapshot_contents)
+        switch_session_dataset(store, session_id, dataset_key)
+        st.session_state['upload_ids'] = upload_ids
+    else:
+        dataset_key = st.session_state['dataset_key']
+
+    dataset = store.get(dataset_key, session_id)
+    if dataset is not None:
+        return dataset
+
+    # Start a run for these uploads, cancelling the run of files that were replaced
+    job = st.session_state.get('ingestion_job')
+    if job is None or job.dataset_key != dataset_key:
+        cancel_ingestion_job()
+        job = IngestionJob(dataset_key)
+        export_files = tuple(uploaded_file.getvalue() for uploaded_file in uploaded_files)
+        snapshot_contents = snapshot_file.getvalue() if snapshot_file is not None else None
+        job.future = get_ingestion_executor().submit(
+            store.acquire, dataset_key, session_id,
+            lambda: load_exports(load_mode, export_files, snapshot_contents, job.report_progress)
+        )
+        st.session_state['ingestion_job'] = job
+
+    if job.future.done():
+        st.session_state.pop('ingestion_job', None)
+        return job.future.result()  # Errors from the run are raised here and shown like any other
+
+    with st.status(f"Processing uploads: {job.stage}...", expanded=True):
+        st.progress(job.fraction, text=job.stage)
+    time.sleep(0.5)
+    st.rerun()
+
+# Optional local database the exports are ingested into once, then served from for every session
+DEAL_DATABASE_PATH = Path(os.environ.get('DEAL_DATABASE_PATH', 'deal_task_management.db'))
+
+# Version of the local database layout; a database written by an older version has to be saved again
+DATABASE_VERSION = 2
+
+# Indexed columns of the database tables; dashboard reads filter and count on these
+DATABASE_INDEXES = {
+    'deals': [['Regarding']],
+    'tasks': [['Regarding', 'Status Reason'], ['Due Date'], ['Owner']],
+    'appointments': [['Regarding'], ['Owner']],
+    'search_postings': [['token']]
+}
+
+# Date columns stored as YYYY-MM-DD text, so their indexes are in date order and serve range queries
+DATABASE_DATE_COLUMNS = {
+    'deals': DEAL_DATE_COLUMNS,
+    'tasks': SQL_DATE_COLUMNS['tasks'],
+    'appointments': SQL_DATE_COLUMNS['appointments']
+}
+
+# Function to convert the date columns of a frame to YYYY-MM-DD text, from datetimes or mm/dd/yyyy text
+def to_database_dates(df, date_columns):
+    return df.assign(**{
+        col: pd.to_datetime(df[col], format=None if pd.api.types.is_datetime64_any_dtype(df[col]) else '%m/%d/%Y', errors='coerce').dt.strftime('%Y-%m-%d')
+        for col in date_columns if col in df.columns
+    })
+
+# Function to convert YYYY-MM-DD text read from the database back to mm/dd/yyyy text
+def from_database_dates(df, date_columns):
+    return df.assign(**{
+        col: pd.to_datetime(df[col], format='%Y-%m-%d', errors='coerce').dt.strftime('%m/%d/%Y')
+        for col in date_columns if col in df.columns
+    })
+
+# Function to ingest the normalized frames of an uploaded dataset into the local database, replacing its tables.
+# pandas commits after every to_sql, so the rows are written to staging tables first and swapped in with one
+# transaction; other app instances reading the file see either all of the old tables or all of the new ones.
+def ingest_into_database(dataset, db_path=DEAL_DATABASE_PATH):
+    frames = get_dataset_frames(dataset)
+    search_index = dataset['search_index']
+    with closing(sqlite3.connect(db_path)) as connection:
+        connection.execute('PRAGMA journal_mode=WAL')  # Readers in other app instances are not blocked by an ingest
+        to_database_dates(frames['deals'], DATABASE_DATE_COLUMNS['deals']).to_sql('deals_staging', connection, if_exists='replace', index=False)
+
+        # Tasks and appointments keep their row ids, which the urgency buckets are aligned on
+        for table in ['tasks', 'appointments']:
+            to_database_dates(frames[table], DATABASE_DATE_COLUMNS[table]).reset_index(names='row_id').to_sql(f'{table}_staging', connection, if_exists='replace', index=False)
+
+        # The search index goes in as (token, deal position) rows, so searches are indexed lookups
+        pd.DataFrame({
+            'token': np.repeat(search_index['tokens'], [len(postings) for postings in search_index['postings']]),
+            'position': np.concatenate(search_index['postings'] or [np.empty(0, dtype=np.int64)])
+        }).to_sql('search_postings_staging', connection, if_exists='replace', index=False)
+
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for table, indexes in DATABASE_INDEXES.items():
+                connection.execute(f'DROP TABLE IF EXISTS {table}')
+                connection.execute(f'ALTER TABLE {table}_staging RENAME TO {table}')
+                for columns in indexes:
+                    index_name = f"idx_{table}_" + '_'.join(re.sub(r'\W+', '_', col).lower() for col in columns)
+                    column_list = ', '.join(f'"{col}"' for col in columns)
+                    connection.execute(f'CREATE INDEX {index_name} ON {table} ({column_list})')
+            connection.execute(f'PRAGMA user_version = {DATABASE_VERSION}')
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+
+# Function to open the local database read-only, so several app instances can share the file
+def connect_database_read_only(db_path=DEAL_DATABASE_PATH):
+    return sqlite3.connect(f"{Path(db_path).resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+
+# Function to read a whole table of the local database, with its dates back in the app's formats
+def read_database_table(connection, table):
+    if table == 'deals':
+        df = pd.read_sql_query('SELECT * FROM deals ORDER BY rowid', connection, parse_dates={col: {'format': '%Y-%m-%d'} for col in DEAL_DATE_COLUMNS})
+        df['Days to IP Expiration'] = df['Days to IP Expiration'].astype('Int64')
+        return df
+    df = pd.read_sql_query(f'SELECT * FROM {table}', connection, index_col='row_id')
+    df.index.name = None
+    return from_database_dates(df, DATABASE_DATE_COLUMNS[table])
+
+# Function to return the deals, tasks and appointments frames of a dataset.
+# For the local database the task and appointment tables are read in full, so only on demand (downloads, saves).
+def get_dataset_frames(dataset):
+    if not dataset['database']:
+        return {table: dataset[table] for table in ['deals', 'tasks', 'appointments']}
+    with closing(connect_database_read_only(dataset['database'])) as connection:
+        return {table: read_database_table(connection, table) for table in ['deals', 'tasks', 'appointments']}
+
+# Related tasks and appointments of a deal, read from the local database with indexed queries
+# when a deal is rendered instead of being grouped in memory at load time
+class DatabaseDealGroups:
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def __contains__(self, deal_name):
+        return True
+
+    def __getitem__(self, deal_name):
+        with closing(connect_database_read_only(self.db_path)) as connection:
+            tasks = pd.read_sql_query('SELECT * FROM tasks WHERE "Regarding" = ?', connection, params=[deal_name], index_col='row_id')
+            appointments = pd.read_sql_query('SELECT * FROM appointments WHERE "Regarding" = ?', connection, params=[deal_name], index_col='row_id')
+            status_counts = dict(connection.execute(
+                'SELECT "Status Reason", count(*) FROM tasks WHERE "Regarding" = ? GROUP BY "Status Reason"', [deal_name]
+            ).fetchall())
+
+        tasks.index.name = appointments.index.name = None
+        return {
+            'tasks': from_database_dates(tasks, DATABASE_DATE_COLUMNS['tasks']).sort_values(by='Actual End', ascending=True),
+            'appointments': from_database_dates(appointments, DATABASE_DATE_COLUMNS['appointments']),
+            'counts': {
+                'Show All': len(tasks),
+                'In Progress': status_counts.get('In Progress', 0),
+                'Completed': status_counts.get('Completed', 0),
+                'Not Started': status_counts.get('Not Started', 0)
+            }
+        }
+
+# SQL conditions of the predefined deal filters, evaluated by the local database
+DATABASE_DEAL_FILTERS = {
+    'Greenfolder Approved, Not Yet Closed': '"CIC Final Approval Date" IS NOT NULL',
+    'Green Folder Schedule': '"GF Submittal Date" IS NOT NULL AND "CIC Final Approval Date" IS NULL',
+    'Letters of Intent': """"Calculated Deal Stage" IN ('LOI', 'Not under LOI')"""
+}
+
+# Function to build the deal filter masks with SQL; deal positions follow the rowid order the deals are read in
+def build_database_filter_masks(db_path):
+    with closing(connect_database_read_only(db_path)) as connection:
+        deal_count = connection.execute('SELECT count(*) FROM deals').fetchone()[0]
+        filter_masks = {'All Deals': np.ones(deal_count, dtype=bool)}
+        for deal_filter, condition in DATABASE_DEAL_FILTERS.items():
+            positions = [row[0] for row in connection.execute(
+                f'SELECT position FROM (SELECT row_number() OVER (ORDER BY rowid) - 1 AS position, * FROM deals) WHERE {condition}'
+            )]
+            filter_masks[deal_filter] = np.zeros(deal_count, dtype=bool)
+            filter_masks[deal_filter][positions] = True
+    return filter_masks
+
+# Function to find the positions of the deals matching every word of the search text in the database's search index.
+# The last word is matched as a prefix, like search_deals.
+def search_database_deals(db_path, search_text):
+    query_tokens = SEARCH_TOKEN_PATTERN.findall(search_text.lower())
+    matches = None
+    with closing(connect_database_read_only(db_path)) as connection:
+        for i, query_token in enumerate(query_tokens):
+            if i == len(query_tokens) - 1:
+                rows = connection.execute('SELECT DISTINCT position FROM search_postings WHERE token >= ? AND token < ?', [query_token, query_token + '\uffff'])
+            else:
+                rows = connection.execute('SELECT DISTINCT position FROM search_postings WHERE token = ?', [query_token])
+            token_matches = np.array([row[0] for row in rows], dtype=np.int64)
+            matches = np.unique(token_matches) if matches is None else np.intersect1d(matches, token_matches)
+    return matches
+
+# Function to count the overdue open tasks per (Owner, Regarding) on a day with an indexed range query on 'Due Date'
+def count_overdue_tasks_in_database(db_path, as_of_date):
+    with closing(connect_database_read_only(db_path)) as connection:
+        return pd.read_sql_query(
+            'SELECT "Owner", "Regarding", count(*) AS "Tasks" FROM tasks '
+            'WHERE "Due Date" < ? AND ("Status Reason" IS NULL OR "Status Reason" != \'Completed\') '
+            'GROUP BY "Owner", "Regarding"',
+            connection, params=[f"{as_of_date:%Y-%m-%d}"]
+        )
+
+# Function to load a dataset from the local database. Only the deals are read; task and appointment rows,
+# filters, search and the overdue counts stay in the database, so opening it does not grow with their size.
+def load_database(db_path=DEAL_DATABASE_PATH):
+    with closing(connect_database_read_only(db_path)) as connection:
+        if connection.execute('PRAGMA user_version').fetchone()[0] != DATABASE_VERSION:
+            raise ValueError(f"{db_path} was saved by an older version of this app. Save the exports to the local database again.")
+        deals_df = read_database_table(connection, 'deals')
+        tasks_df = pd.read_sql_query('SELECT * FROM tasks LIMIT 0', connection, index_col='row_id')
+        appointments_df = pd.read_sql_query('SELECT * FROM appointments LIMIT 0', connection, index_col='row_id')
+
+    tasks_df.index.name = appointments_df.index.name = None
+    deals_df, = apply_shared_categories(deals_df)
+    match_report = pd.DataFrame(columns=['Appointment Regarding', 'Matched Deal', 'Match Method', 'Match Confidence', 'Appointments'])
+    return build_dataset(deals_df, tasks_df, appointments_df, DatabaseDealGroups(db_path), set(), match_report, database=db_path)
+
+# Function to attach this session to the dataset of the local database, reloaded when the file changes
+def acquire_database_dataset(db_path=DEAL_DATABASE_PATH):
+    store = get_dataset_store()
+    session_id = get_script_run_ctx().session_id
+    dataset_key = f"database:{Path(db_path).resolve()}:{os.stat(db_path).st_mtime_ns}"
+    switch_session_dataset(store, session_id, dataset_key)
+    return store.acquire(dataset_key, session_id, lambda: load_database(db_path))
+
+# Function to render the button that ingests the uploaded exports into the local database
+def render_database_ingest(dataset):
+    with st.expander("Local Database"):
+        st.caption(f"Save these exports to {DEAL_DATABASE_PATH} so every app instance can open them with the 'Local database' load mode, without parsing the workbooks.")
+        if st.button("Save to Local Database"):
+            ingest_into_database(dataset)
+            st.success(f"Saved {len(dataset['deals'])} deals to {DEAL_DATABASE_PATH}.")
+
+# Predefined deal filters, stored in session state by name only
+DEAL_FILTERS = ['Greenfolder Approved, Not Yet Closed', 'Green Folder Schedule', 'Letters of Intent']
+
+# Function to compute the row mask of a predefined deal filter
+def deal_filter_mask(deals_df, deal_filter):
+    if deal_filter == 'Greenfolder Approved, Not Yet Closed':
+        return deals_df['CIC Final Approval Date'].notna()
+    if deal_filter == 'Green Folder Schedule':
+        return deals_df['GF Submittal Date'].notna() & deals_df['CIC Final Approval Date'].isna()
+    if deal_filter == 'Letters of Intent':
+        return deals_df['Calculated Deal Stage'].isin(['LOI', 'Not under LOI'])
+    return pd.Series(True, index=deals_df.index)  # All Deals
+
+# Function to precompute the membership mask of every predefined deal filter once per dataset
+def build_deal_filter_masks(deals_df):
+    filter_masks = {deal_filter: deal_filter_mask(deals_df, deal_filter).to_numpy() for deal_filter in DEAL_FILTERS}
+    filter_masks['All Deals'] = np.ones(len(deals_df), dtype=bool)
+    return filter_masks
+
+# The options of the "Sort Deals" box
+DEAL_SORT_COLUMNS = ["Projected Deal First Closing Date", "GF Submittal Date", "Calculated Deal Stage", "Sub-Market"]
+
+# Function to turn a column into sortable integer ranks, with missing values ranked last
+def sort_ranks(values):
+    ranks, uniques = pd.factorize(values, sort=True)
+    ranks[ranks == -1] = len(uniques)
+    return ranks
+
+# Function to precompute the row order of the deals for every sort option, in both directions
+def build_sort_permutations(deals_df):
+    regarding_ranks = sort_ranks(deals_df['Regarding'])  # Regarding is always ascending
+    sort_permutations = {}
+    for sort_column in DEAL_SORT_COLUMNS:
+        ranks = sort_ranks(deals_df[sort_column])
+        missing = deals_df[sort_column].isna().to_numpy()
+
+        # np.lexsort sorts by the last key first; missing values stay last in both directions
+        sort_permutations[(sort_column, True)] = np.lexsort((regarding_ranks, ranks, missing))
+        sort_permutations[(sort_column, False)] = np.lexsort((regarding_ranks, -ranks, missing))
+    return sort_permutations
+
+# Function to resolve the positions of the deals to show for a filter and sort order.
+# Ordering a subset keeps the rows of the cached permutation that are in the filter, without sorting.
+def resolve_deal_view(dataset, deal_filter, sort_column, ascending):
+    def compute():
+        mask = dataset['filter_masks'][deal_filter or 'All Deals']
+        sort_permutation = dataset['sort_permutations'][(sort_column, ascending)]
+        return sort_permutation[mask[sort_permutation]]
+    return get_derived(dataset, ('deal_view', deal_filter, sort_column, ascending), compute)
+
+# Text columns of each frame covered by the full-text deal search
+SEARCH_INDEX_COLUMNS = {
+    'deals': ['Regarding', 'Primary Seller Company'],
+    'tasks': ['Subject', 'Comment', 'Vendor Assigned'],
+    'appointments': ['Subject', 'Description']
+}
+SEARCH_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+# Function to build an inverted index from lowercase tokens to the positions of the deals they appear in
+def build_search_index(deals_df, tasks_df, appointments_df):
+    # Tasks and appointments share the Regarding categories with the deals, so codes map straight to deal positions
+    regarding = deals_df['Regarding'].cat
+    position_by_code = np.full(len(regarding.categories) + 1, -1)
+    position_by_code[regarding.codes.to_numpy()] = np.arange(len(deals_df))
+
+    postings = []
+    for frame_name, df in [('deals', deals_df), ('tasks', tasks_df), ('appointments', appointments_df)]:
+        if not isinstance(df['Regarding'].dtype, pd.CategoricalDtype) or not df['Regarding'].cat.categories.equals(regarding.categories):
+            continue  # Rows that cannot be tied to a deal are not searchable
+        positions = position_by_code[df['Regarding'].cat.codes.to_numpy()]
+        for col in SEARCH_INDEX_COLUMNS[frame_name]:
+            if col not in df.columns:
+                continue
+            tokens = df[col].astype('string').str.lower().str.findall(SEARCH_TOKEN_PATTERN)
+            postings.append(pd.DataFrame({'token': tokens, 'position': positions}).explode('token'))
+
+    postings_df = pd.concat(postings, ignore_index=True).dropna()
+    postings_df = postings_df[postings_df['position'] >= 0].drop_duplicates()
+    grouped = postings_df.groupby('token', sort=True)['position']
+    return {
+        'tokens': np.array(list(grouped.groups.keys()), dtype=object),
+        'postings': [np.sort(group.to_numpy(dtype=np.int64)) for _, group in grouped]
+    }
+
+# Function to find the positions of the deals matching every word of the search text.
+# The last word is matched as a prefix so results show up while typing.
+def search_deals(search_index, search_text):
+    if 'database' in search_index:
+        return search_database_deals(search_index['database'], search_text)
+
+    tokens = search_index['tokens']
+    query_tokens = SEARCH_TOKEN_PATTERN.findall(search_text.lower())
+    matches = None
+    for i, query_token in enumerate(query_tokens):
+        # Tokens are sorted, so all the tokens starting with the query word are one contiguous range
+        start = np.searchsorted(tokens, query_token, side='left')
+        end = np.searchsorted(tokens, query_token + '\uffff' if i == len(query_tokens) - 1 else query_token, side='right')
+        token_matches = np.unique(np.concatenate(search_index['postings'][start:end] or [np.empty(0, dtype=np.int64)]))
+        matches = token_matches if matches is None else np.intersect1d(matches, token_matches, assume_unique=True)
+    return matches
+
+# Function to narrow deal positions to the deal picked in the search box, comparing category codes
+def select_deal_positions(deals_df, deal_positions, selected_deal):
+    regarding = deals_df['Regarding']
+    if selected_deal not in regarding.cat.categories:
+        return deal_positions[:0]
+    selected_code = regarding.cat.categories.get_loc(selected_deal)
+    return deal_positions[regarding.cat.codes.to_numpy()[deal_positions] == selected_code]
+
+# Dates in the deals grid stay typed and are formatted by the browser
+DEAL_GRID_COLUMN_CONFIG = {col: st.column_config.DateColumn(col, format="MM/DD/YYYY") for col in DEAL_DATE_COLUMNS}
+
+# Function to render the deals being shown as one grid and return the ones whose rows are selected.
+# Without a selection every deal in the grid gets a detail panel.
+def render_deals_grid(visible_deals_df):
+    st.markdown(f"**Deals ({len(visible_deals_df)})**: select rows to show only those deals below")
+    deal_selection = st.dataframe(
+        visible_deals_df,
+        hide_index=True,
+        column_config=DEAL_GRID_COLUMN_CONFIG,
+        on_select="rerun",
+        selection_mode="multi-row",
+        key="deals_grid"
+    )
+    # A selection can outlive a filter change that shortened the grid
+    selected_rows = [row for row in deal_selection["selection"]["rows"] if row < len(visible_deals_df)]
+    if selected_rows:
+        return visible_deals_df.iloc[sorted(selected_rows)]
+    return visible_deals_df
+
+# The task filters of a deal; a deal's filter is kept in session state as its index in this list
+TASK_FILTERS = ["Show All", "In Progress", "Completed", "Not Started"]
+TASK_FILTER_LABELS = {"Show All": "Show All Tasks"}
+
+# Function to return the session's map of deal name to task filter code; deals showing all tasks are left out
+def get_task_filters():
+    return st.session_state.setdefault('task_filters', {})
+
+# Function to remember the task filter chosen for a deal, run before the fragment reruns
+def set_task_filter(deal_name, filter_code):
+    task_filters = get_task_filters()
+    if filter_code:
+        task_filters[deal_name] = filter_code
+    else:
+        task_filters.pop(deal_name, None)
+
+# Function to return a deal's tasks with their urgency, narrowed to one status.
+# Filtered views are memoized per (deal, status, day) in their own bounded cache, so going back to a filter
+# costs a lookup without evicting the dataset-wide results; the unfiltered view is cheap and not cached.
+def get_task_view(dataset, deal_name, deal_group, urgency, filter_code, as_of_date):
+    if not filter_code:
+        return with_urgency(deal_group['tasks'], urgency['tasks'])
+
+    def compute():
+        deal_tasks = with_urgency(deal_group['tasks'], urgency['tasks'])
+        return deal_tasks[deal_tasks['Status Reason'] == TASK_FILTERS[filter_code]]
+    return get_derived(dataset, (deal_name, filter_code, as_of_date), compute, cache='task_views', max_size=TASK_VIEW_CACHE_SIZE)
+
+# Function to render one deal's task filter, tasks, appointments and Gantt chart as a fragment,
+# so clicking its buttons reruns only this deal instead of the whole page
+@st.fragment
+def render_deal_panel(dataset, idx, deal, deal_group, urgency, as_of_date, expanded):
+    deal_name = deal['Regarding']
+    filter_code = get_task_filters().get(deal_name, 0)
+
+    # Create a row of buttons for filtering tasks with unique keys; the chosen filter is highlighted
+    columns = st.columns([0.1, 1.2, 1, 1, 1, 2, 2, 2])
+    for code, (column, task_filter) in enumerate(zip(columns[1:5], TASK_FILTERS)):
+        with column:
+            st.button(
+                f"{TASK_FILTER_LABELS.get(task_filter, task_filter)} ({deal_group['counts'][task_filter]})",
+                key=f"{deal_name}_{task_filter.lower().replace(' ', '_')}_{idx}",
+                type="primary" if code == filter_code else "secondary",
+                on_click=set_task_filter,
+                args=(deal_name, code)
+            )
+
+    filtered_tasks_df = get_task_view(dataset, deal_name, deal_group, urgency, filter_code, as_of_date)
+
+    # Construct the label for the expander
+    task_count = len(filtered_tasks_df)
+    expander_label = f"Related Tasks ({task_count})"
+
+    # Display the tasks in an expander
+    with st.expander(expander_label, expanded=expanded):
+        if not filtered_tasks_df.empty:
+            # Urgency is shown as a badge column, so no per-cell styles are sent
+            badged_tasks = apply_conditional_formatting(filtered_tasks_df.drop(columns=['Regarding']))
+            st.dataframe(badged_tasks, hide_index=True, column_config=TASK_TABLE_COLUMN_CONFIG)  # Let Streamlit automatically determine the height
+        else:
+            st.write("No related tasks found.")
+
+    # Fetch and display related Appointments
+    related_appointments = with_urgency(deal_group['appointments'].drop(columns=['Regarding']), urgency['appointments'])
+
+    # Calculate the number of related appointments
+    appointment_count = len(related_appointments)
+
+    # Display related appointments in the expander with urgency badges
+    with st.expander(f"Related Appointments ({appointment_count})", expanded=expanded):
+        if not related_appointments.empty:
+            badged_appointments = apply_appointment_formatting(related_appointments)
+            st.dataframe(badged_appointments, hide_index=True, column_config=APPOINTMENT_TABLE_COLUMN_CONFIG)
+        else:
+            st.write("No related appointments found.")
+
+    # Gantt chart generation button using Streamlit with custom styling
+    if st.button(f"Generate Gantt Chart for {deal_name}", key=f"gantt_{idx}_{deal_name}"):
+        fig = generate_gantt_chart(deal_name, deal, filtered_tasks_df, as_of_date)
+        st.plotly_chart(fig)
+
+# Deal panels are rendered one page at a time
+DEALS_PER_PAGE_OPTIONS = [10, 25, 50, 100]
+
+# Function to set whether the task and appointment expanders of the deals on the page start expanded
+def set_expand_all(expand_all):
+    st.session_state['expand_all'] = expand_all
+
+# Function to move the deal panels to another page
+def set_deal_page(page):
+    st.session_state['deal_page'] = page
+
+# Function to render the page controls of the deal panels and return the start and stop of the current page
+def render_deal_pages(deal_count, deals_per_page, columns):
+    page_count = max(1, -(-deal_count // deals_per_page))
+    # The page is clamped, as a new filter or search can leave fewer pages than before
+    page = min(st.session_state.get('deal_page', 0), page_count - 1)
+    page_start, page_stop = page * deals_per_page, min((page + 1) * deals_per_page, deal_count)
+
+    previous_column, caption_column, next_column = columns
+    with previous_column:
+        st.button("◀ Previous", disabled=page == 0, on_click=set_deal_page, args=(page - 1,))
+    with caption_column:
+        st.caption(f"Deals {page_start + 1 if deal_count else 0}–{page_stop} of {deal_count}")
+    with next_column:
+        st.button("Next ▶", disabled=page >= page_count - 1, on_click=set_deal_page, args=(page + 1,))
+    return page_start, page_stop
+
+# Choose between parsing a full export and refreshing a previous snapshot with a delta export
+load_mode = st.radio(
+    "Load mode:",
+    options=["Full export", "Incremental refresh", "Local database"],
+    index=0,
+    horizontal=True,
+    help="Incremental refresh merges a delta export (rows changed since a date) into a previously downloaded normalized snapshot. Local database serves the exports last saved to the local database file."
+)
+
+snapshot_file = None
+if load_mode == "Incremental refresh":
+    snapshot_file = st.file_uploader(
+        "Choose the previous normalized snapshot",
+        type="xlsx",
+        help="The 'Download Normalized Snapshot' workbook from a previous run"
+    )
+
+# Load the Excel files
+uploaded_files = []
+if load_mode != "Local database":
+    uploaded_files = st.file_uploader(
+        "Choose Excel files",
+        type="xlsx",
+        accept_multiple_files=True,
+        help="Upload two Excel files: one for Deals/Tasks and one for Appointments. For an incremental refresh, upload the delta exports (one or both)."
+    )
+
+if load_mode == "Full export":
+    files_ready = bool(uploaded_files) and len(uploaded_files) == 2
+elif load_mode == "Incremental refresh":
+    files_ready = snapshot_file is not None and bool(uploaded_files) and len(uploaded_files) <= 2
+else:
+    files_ready = DEAL_DATABASE_PATH.exists()
+
+if files_ready:
+    try:
+        if load_mode == "Local database":
+            dataset = acquire_database_dataset()
+        else:
+            dataset = acquire_session_dataset(load_mode, uploaded_files, snapshot_file)
+        deals_df = dataset['deals']
+        tasks_df = dataset['tasks']
+        appointments_df = dataset['appointments']
+        deal_groups = dataset['groups']
+
+        if load_mode == "Incremental refresh":
+            st.success(f"Incremental refresh merged changes for {len(dataset['affected_deals'])} deal(s).")
+
+        # Show the appointments whose deal name only matched after normalization or fuzzy matching
+        match_report = dataset['match_report']
+        if not match_report.empty:
+            unmatched_count = int(match_report.loc[match_report['Match Method'] == 'Unmatched', 'Appointments'].sum())
+            with st.expander(f"Appointment Matching ({len(match_report)} deal name(s) not matched exactly, {unmatched_count} appointment(s) unmatched)"):
+                st.dataframe(match_report, hide_index=True)
+
+        # Day counts, urgency colors, Gantt ranges and the summary are all derived against the as-of date,
+        # so a past report can be reproduced and each date is only computed once per dataset
+        as_of_date = pd.Timestamp(st.date_input(
+            "As-of date:",
+            value=datetime.now().date(),
+            help="Review the deals, urgency colors and summary as they were (or will be) on this date"
+        ))
+
+        # Portfolio-wide numbers, before the per-deal blocks
+        render_portfolio_summary(get_portfolio_kpis(dataset, as_of_date))
+        render_snapshot_history(dataset, as_of_date)
+        render_sql_query(dataset, as_of_date)
+        if load_mode != "Local database":
+            render_database_ingest(dataset)
+
+
+        # Deal Filters: counts come from the masks precomputed for this dataset
+        filter_masks = dataset['filter_masks']
+
+        # Adjust columns to decrease space between buttons by using narrower column ratios
+        col1, col2, col3, col4, col5, col6, col7, col8 = st.columns([0.1, 2.5, 1.8, 1.5, 1.1, 1.5, 1.5, 1.5])
+
+        # Handle button clicks for filtering; only the filter name is kept in session state
+        for column, deal_filter in zip([col2, col3, col4], DEAL_FILTERS):
+            with column:
+                if st.button(f"{deal_filter} ({int(filter_masks[deal_filter].sum())})"):
+                    st.session_state['deal_filter'] = deal_filter
+        with col5:
+            total_deals_count = len(deals_df)
+            if st.button(f"All Deals ({total_deals_count})"):
+                st.session_state.pop('deal_filter', None)  # Clear the deal filter state to reset to all deals
+
+        # Sorting UI/UX
+        with st.expander("Sort Deals"):
+            sort_column = st.selectbox(
+                "Sort by:",
+                options=DEAL_SORT_COLUMNS,
+                index=0
+            )
+
+            sort_order = st.radio(
+                "Sort Order:",
+                options=["Ascending", "Descending"],
+                index=0,
+                horizontal=True
+            )
+
+        # Default to showing all deals if no button is clicked
+        deal_positions = resolve_deal_view(dataset, st.session_state.get('deal_filter'), sort_column, sort_order == "Ascending")
+
+        # Search Functionality using Dropdown with Search
+        with st.expander("Search for Specific Deal"):
+            search_text = st.text_input(
+                "Search deals, tasks and appointments:",
+                help="Matches deal names, sellers, task subjects, comments, vendors and appointment descriptions"
+            )
+
+            # Keep the deals found through the search index, in the current sort order
+            if search_text.strip():
+                search_matches = search_deals(dataset['search_index'], search_text)
+                if search_matches is not None:
+                    deal_positions = deal_positions[np.isin(deal_positions, search_matches)]
+                    st.caption(f"{len(deal_positions)} matching deal(s)")
+
+            deal_names = [""] + deals_df['Regarding'].iloc[deal_positions].dropna().unique().tolist()
+
+            selected_deal = st.selectbox("Select a Deal:", deal_names)
             
-            # Convert date fields to datetime and extract only the date
-            date_columns = ['GF Submittal Date', 'Green Folder Meeting Date', 'IP Expiration Date', 'Projected Deal First Closing Date', 'CIC Final Approval Date', 'Actual Contract Execution Date']
-            deals_df[date_columns] = deals_df[date_columns].apply(lambda x: pd.to_datetime(x, errors='coerce').dt.strftime('%m/%d/%Y'))
-
-            # Extract tasks data
-            tasks_df = deals_tasks_df[task_columns + ['Regarding']].drop_duplicates().reset_index(drop=True)
-
-            # Ensure 'Actual End' exists
-            if 'Actual End' not in tasks_df.columns:
-                tasks_df['Actual End'] = pd.NaT  # Ensure the column exists to avoid errors
-
-            # Ensure unique columns before further processing
-            if tasks_df.columns.duplicated().any():
-                tasks_df = tasks_df.loc[:, ~tasks_df.columns.duplicated()]
-
-            # Format date fields, including "Actual End", "Start Date", "Due Date", and "Modified On"
-            date_columns = ['Start Date', 'Due Date', 'Modified On', 'Actual End']
-            existing_date_columns = [col for col in date_columns if col in tasks_df.columns]
-
-            # Convert to datetime
-            if existing_date_columns:
-                tasks_df[existing_date_columns] = tasks_df[existing_date_columns].apply(lambda x: pd.to_datetime(x, errors='coerce'))
-
-            # Format the dates as mm/dd/yyyy
-            tasks_df[existing_date_columns] = tasks_df[existing_date_columns].apply(lambda x: x.dt.strftime('%m/%d/%Y'))
-
-            # You can then sort the DataFrame by any date column as needed
-            tasks_df = tasks_df.sort_values(by='Actual End', ascending=True)
-
-            # Extract and clean appointments data
-            appointments_df[['Start Time', 'End Time']] = appointments_df[['Start Time', 'End Time']].apply(lambda x: pd.to_datetime(x, errors='coerce'))
-
-            # Convert 'Modified On' to datetime if it exists
-            if 'Modified On' in appointments_df.columns:
-                appointments_df['Modified On'] = pd.to_datetime(appointments_df['Modified On'], errors='coerce')
-
-            # Format the dates as mm/dd/yyyy
-            appointments_df[['Modified On', 'Start Time', 'End Time']] = appointments_df[['Modified On', 'Start Time', 'End Time']].apply(lambda x: x.dt.strftime('%m/%d/%Y'))
-
-            # Deal Filters
-
-            # Greenfolder Approved, Not Yet Closed
-            greenfolder_approved_df = deals_df[deals_df['CIC Final Approval Date'].notna()]
-
-            # Green Folder Schedule
-            green_folder_schedule_df = deals_df[
-                (deals_df['GF Submittal Date'].notna()) &
-                (deals_df['CIC Final Approval Date'].isna())
-            ]
-
-            # Letters of Intent with sorting by Calculated Deal Stage and Sub-Market
-            letters_of_intent_df = deals_df[
-                (deals_df['Calculated Deal Stage'].isin(['LOI', 'Not under LOI']))
-            ]
-
-            # Adjust columns to decrease space between buttons by using narrower column ratios
-            col1, col2, col3, col4, col5, col6, col7, col8 = st.columns([0.1, 2.5, 1.8, 1.5, 1.1, 1.5, 1.5, 1.5])
-
-            # Handle button clicks for filtering
-            with col2:
-                if st.button(f"Greenfolder Approved, Not Yet Closed ({len(greenfolder_approved_df)})"):
-                    st.session_state['deal_filter'] = 'Greenfolder Approved, Not Yet Closed'
-                    st.session_state['filtered_deals_df'] = greenfolder_approved_df
-            with col3:
-                if st.button(f"Green Folder Schedule ({len(green_folder_schedule_df)})"):
-                    st.session_state['deal_filter'] = 'Green Folder Schedule'
-                    st.session_state['filtered_deals_df'] = green_folder_schedule_df
-            with col4:
-                if st.button(f"Letters of Intent ({len(letters_of_intent_df)})"):
-                    st.session_state['deal_filter'] = 'Letters of Intent'
-                    st.session_state['filtered_deals_df'] = letters_of_intent_df 
-            with col5:
-                total_deals_count = len(deals_df)
-                if st.button(f"All Deals ({total_deals_count})"):
-                    st.session_state.pop('filtered_deals_df', None)  # Remove the filtered deals to reset to all deals
-                    st.session_state.pop('deal_filter', None)  # Clear the deal filter state as well
-
-            # Default to showing all deals if no button is clicked
-            if 'filtered_deals_df' not in st.session_state:
-                st.session_state['filtered_deals_df'] = deals_df
-
-            filtered_deals_df = st.session_state['filtered_deals_df']
-
-            # Convert date fields to datetime for sorting purposes
-            date_columns = ['GF Submittal Date', 'Green Folder Meeting Date', 'IP Expiration Date', 'Projected Deal First Closing Date', 'CIC Final Approval Date']
-
-            # Apply pd.to_datetime to each column individually, handling errors
-            for col in date_columns:
-                filtered_deals_df[col] = pd.to_datetime(filtered_deals_df[col], errors='coerce')
-
-            # Sorting UI/UX
-            with st.expander("Sort Deals"):
-                sort_column = st.selectbox(
-                    "Sort by:",
-                    options=["Projected Deal First Closing Date", "GF Submittal Date", "Calculated Deal Stage", "Sub-Market"],
-                    index=0
-                )
-
-                sort_order = st.radio(
-                    "Sort Order:",
-                    options=["Ascending", "Descending"],
-                    index=0,
-                    horizontal=True
-                )
-
-                # Apply sorting by user's choice
-                filtered_deals_df = filtered_deals_df.sort_values(
-                    by=[sort_column, 'Regarding'],  # Multi-level sorting
-                    ascending=[(sort_order == "Ascending"), True]  # Regarding is always ascending
-                )
-
-            # After sorting, format the date columns for display
-            for col in date_columns:
-                if pd.api.types.is_datetime64_any_dtype(filtered_deals_df[col]):
-                    filtered_deals_df[col] = filtered_deals_df[col].dt.strftime('%m/%d/%Y')
-
-            # Now you can continue with other operations
-
-
-            # Search Functionality using Dropdown with Search
-            with st.expander("Search for Specific Deal"):
-                deal_names = [""] + filtered_deals_df['Regarding'].dropna().unique().tolist()
-
-                selected_deal = st.selectbox("Select a Deal:", deal_names)
-                
-                # Filter the DataFrame based on the selected deal
-                if selected_deal:
-                    filtered_deals_df = filtered_deals_df[filtered_deals_df['Regarding'] == selected_deal]
-
-            # Add buttons to minimize/maximize all tasks and appointments
-            col1, col2, col3, col4, col5, col6, col7, col8 = st.columns([.1, 1, 1, 1.5, 1.5, 1.5, 1.5, 1.5])
-
-            with col2:
-                minimize_all_button = st.button("Minimize All")
-            with col3:
-                maximize_all_button = st.button("Maximize All")
-                
-            # Initialize expander states at the start
-            expander_states = {}
-
-            # Minimize/Maximize all tasks and appointments
-            if minimize_all_button:
-                expander_states = {deal: False for deal in filtered_deals_df['Regarding']}
-            if maximize_all_button:
-                expander_states = {deal: True for deal in filtered_deals_df['Regarding']}
-
-            # Loop through filtered deals
-            for idx, deal in filtered_deals_df.iterrows():
-                deal_name = deal['Regarding']
-
-                # Add a 'Return to Top' link next to the deal name with a home emoji
-                return_to_top_link = f"<a href='#top' style='text-decoration: none; color: #015CAB;'>🏠</a>"
-                go_to_download_link = f"<a href='#download' style='text-decoration: none; color: #015CAB;'>📥</a>"
-                st.markdown(f"<h3>{deal_name} {return_to_top_link} {go_to_download_link}</h3>", unsafe_allow_html=True)
-
-                # Display Deal Data
-                deal_data = deal.to_frame().T
-                st.table(deal_data)
-
-                # Write Deal Data to Excel
-                deal_data.to_excel(writer, startrow=current_row, index=False, header=True, sheet_name='Data')
-                current_row += len(deal_data) + 2  # Adjust row position
-
-                # Fetch and display related Tasks
-                filtered_tasks_df = tasks_df[tasks_df['Regarding'] == deal_name]
-
-                # Count the number of tasks per status
-                in_progress_count = filtered_tasks_df[filtered_tasks_df['Status Reason'] == 'In Progress'].shape[0]
-                completed_count = filtered_tasks_df[filtered_tasks_df['Status Reason'] == 'Completed'].shape[0]
-                not_started_count = filtered_tasks_df[filtered_tasks_df['Status Reason'] == 'Not Started'].shape[0]
-                total_tasks_count = len(filtered_tasks_df)
-
-                # Initialize task_filter with a default value
-                task_filter = "Show All"  # Default filter value
-
-                # Create a row of buttons for filtering tasks with unique keys
-                ccol1, col2, col3, col4, col5, col6, col7, col8 = st.columns([0.1, 1.2, 1, 1, 1, 2, 2, 2])
-
-                with col2:
-                    if st.button(f"Show All Tasks ({total_tasks_count})", key=f"{deal_name}_show_all_{idx}"):
-                        task_filter = "Show All"
-                with col3:
-                    if st.button(f"In Progress ({in_progress_count})", key=f"{deal_name}_in_progress_{idx}"):
-                        task_filter = "In Progress"
-                with col4:
-                    if st.button(f"Completed ({completed_count})", key=f"{deal_name}_completed_{idx}"):
-                        task_filter = "Completed"
-                with col5:
-                    if st.button(f"Not Started ({not_started_count})", key=f"{deal_name}_not_started_{idx}"):
-                        task_filter = "Not Started"
-
-                # Filter the DataFrame based on the button clicked
-                if task_filter != "Show All":
-                    filtered_tasks_df = filtered_tasks_df[filtered_tasks_df['Status Reason'] == task_filter]
-
-                # Construct the label for the expander
-                task_count = len(filtered_tasks_df)
-                expander_label = f"Related Tasks ({task_count})"
-
-                # Display the tasks in an expander
-                with st.expander(expander_label, expanded=expander_states.get(deal_name, False)):
-                    if not filtered_tasks_df.empty:
-                        # Pass the DataFrame directly without .style
-                        styled_tasks = apply_conditional_formatting(filtered_tasks_df.drop(columns=['Regarding']))
-                        st.dataframe(styled_tasks)  # Let Streamlit automatically determine the height
-                        # Write Tasks Data to Excel
-                        filtered_tasks_df.drop(columns=['Regarding']).to_excel(writer, startrow=current_row, index=False, header=True, sheet_name='Data')
-                        current_row += len(filtered_tasks_df) + 2
-                    else:
-                        st.write("No related tasks found.")
-                        current_row += 2  # Add spacing even if no tasks
-
-                # Fetch and display related Appointments
-                related_appointments = appointments_df[appointments_df['Regarding'] == deal_name].drop(columns=['Regarding'])
-
-                # Calculate the number of related appointments
-                appointment_count = len(related_appointments)
-
-                # Display related appointments in the expander with conditional formatting
-                with st.expander(f"Related Appointments ({appointment_count})", expanded=expander_states.get(deal_name, False)):
-                    if not related_appointments.empty:
-                        styled_appointments = apply_appointment_formatting(related_appointments)
-                        st.dataframe(styled_appointments)
-                        # Write Appointments Data to Excel
-                        related_appointments.to_excel(writer, startrow=current_row, index=False, header=True, sheet_name='Data')
-                        current_row += len(related_appointments) + 2
-                    else:
-                        st.write("No related appointments found.")
-                        current_row += 2  # Add spacing even if no appointments
-
-                # Gantt chart generation button using Streamlit with custom styling
-                if st.button(f"Generate Gantt Chart for {deal_name}", key=f"gantt_{idx}_{deal_name}"):
-                    fig = generate_gantt_chart(deal_name, deal, filtered_tasks_df)
-                    st.plotly_chart(fig)
-
-                # Add a more prominent separator row
-                st.markdown("<hr style='border: 4px solid #000;'>", unsafe_allow_html=True)  # Thicker horizontal line
-                current_row += 1  # Extra space between deals
-
-            # Adjust column widths for better readability
-            worksheet = writer.sheets['Data']
-            for i, col in enumerate(deal_columns):  # Adjust for deal columns
-                worksheet.set_column(i, i, 20)
-            for i, col in enumerate(task_columns):  # Adjust for task columns
-                worksheet.set_column(i, i, 20)
-            for i, col in enumerate(appointment_columns):  # Adjust for appointment columns
-                worksheet.set_column(i, i, 20)
-
-        # Render the download button after all the writing is done
+            # Filter the deals based on the selected deal
+            if selected_deal:
+                deal_positions = select_deal_positions(deals_df, deal_positions, selected_deal)
+
+        # All deals being shown go to the browser once, as a single grid
+        visible_deals_df = get_deals_as_of(dataset, as_of_date).iloc[deal_positions]
+        filtered_deals_df = render_deals_grid(visible_deals_df)
+
+        # Minimize/Maximize All set a display mode kept in session state; only the deals on the current page are rendered
+        col1, col2, col3, col4, col5, col6, col7, col8 = st.columns([.1, 1, 1, 1.5, 1, 1.5, 1, 1.5])
+
+        with col2:
+            st.button("Minimize All", on_click=set_expand_all, args=(False,))
+        with col3:
+            st.button("Maximize All", on_click=set_expand_all, args=(True,))
+        with col4:
+            deals_per_page = st.selectbox("Deals per page:", DEALS_PER_PAGE_OPTIONS, label_visibility="collapsed", format_func=lambda count: f"{count} deals per page")
+
+        page_start, page_stop = render_deal_pages(len(filtered_deals_df), deals_per_page, [col5, col6, col7])
+        expanded = st.session_state.get('expand_all', False)
+
+        # Loop through the deals on the current page
+        for idx, deal in filtered_deals_df.iloc[page_start:page_stop].iterrows():
+            deal_name = deal['Regarding']
+
+            # Add a 'Return to Top' link next to the deal name with a home emoji
+            return_to_top_link = f"<a href='#top' style='text-decoration: none; color: #015CAB;'>🏠</a>"
+            go_to_download_link = f"<a href='#download' style='text-decoration: none; color: #015CAB;'>📥</a>"
+            st.markdown(f"<h3>{deal_name} {return_to_top_link} {go_to_download_link}</h3>", unsafe_allow_html=True)
+
+            # Fetch the related Tasks and Appointments grouped at load time
+            deal_group = get_deal_group(deal_groups, deal_name, tasks_df, appointments_df)
+            render_deal_panel(dataset, idx, deal, deal_group, get_group_urgency(dataset, deal_group, as_of_date), as_of_date, expanded)
+
+            # Add a more prominent separator row
+            st.markdown("<hr style='border: 4px solid #000;'>", unsafe_allow_html=True)  # Thicker horizontal line
+
+        # Build the workbooks only when a download is requested
         st.markdown('<a name="download"></a>', unsafe_allow_html=True)  # Anchor for download
-        st.download_button(
-            label="Download Excel",
-            data=buffer.getvalue(),
-            file_name=f"deal_task_appointment_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
+        if st.button("Prepare Excel Download"):
+            with st.spinner("Writing workbooks..."):
+                excel_data = build_excel_export(format_dates_for_display(visible_deals_df, DEAL_DATE_COLUMNS), dataset, as_of_date)
+                snapshot_data = write_snapshot(*get_dataset_frames(dataset).values())
+            st.download_button(
+                label="Download Excel",
+                data=excel_data,
+                file_name=f"deal_task_appointment_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+            st.download_button(
+                label="Download Normalized Snapshot",
+                data=snapshot_data,
+                file_name=f"deal_task_snapshot_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                help="Keep this workbook to run an incremental refresh with tomorrow's delta export"
+            )
         # Excel icon URL (You can replace this URL with your own Excel icon)
         excel_icon_url = "https://storage.googleapis.com/absolute_gis_public/Images/lennar%20dashboard%20title.jpg"
         # Adding Excel icon next to Download button and rendering the button
@@ -632,4 +2018,10 @@ if uploaded_files and len(uploaded_files) == 2:
     except Exception as e:
         st.error(f"An error occurred: {e}")
 else:
-    st.info("Please upload exactly two Excel files: one for Deals/Tasks and one for Appointments.")
\ No newline at end of file
+    cancel_ingestion_job()  # The files being processed were removed
+    if load_mode == "Full export":
+        st.info("Please upload exactly two Excel files: one for Deals/Tasks and one for Appointments.")
+    elif load_mode == "Incremental refresh":
+        st.info("Please upload the previous normalized snapshot and one or two delta Excel files.")
+    else:
+        st.info(f"No local database found at {DEAL_DATABASE_PATH}. Upload the exports and use 'Save to Local Database' first.")
\ No newline at end of file
@@ -0,0 +1,50 @@
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+# Measure how long Python spends importing modules when the dashboard script starts, the cost a new
+# session pays before its first page. Usage: python import_benchmark.py [runs] [script]
+APP_SCRIPT = Path(__file__).with_name('deal_task_management.py')
+# plotly itself and pyarrow are pulled in by streamlit and pandas, so only the parts the app loads on demand are listed
+LAZY_MODULES = ['plotly.express', 'bs4', 'xlsxwriter', 'duckdb']
+IMPORTTIME_PATTERN = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$')
+TOP_MODULES = 15
+
+# Function to run the script once under -X importtime and return (module, self us, cumulative us, depth) rows
+def profile_imports(script):
+    env = dict(os.environ, STREAMLIT_GLOBAL_SHOW_WARNING_ON_DIRECT_EXECUTION='false')
+    result = subprocess.run([sys.executable, '-X', 'importtime', str(script)],
+                            capture_output=True, text=True, env=env, cwd=script.parent)
+    rows = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            rows.append((module, int(self_us), int(cumulative_us), (len(indent) - 1) // 2))
+    return rows
+
+# Function to print the total import time, the slowest top-level imports and which lazy modules were loaded
+def report(runs, script):
+    totals = []
+    for _ in range(runs):
+        rows = profile_imports(script)
+        totals.append(sum(self_us for _, self_us, _, _ in rows))
+
+    top_level = sorted((row for row in rows if row[3] == 0), key=lambda row: row[2], reverse=True)
+    loaded = {module for module, _, _, _ in rows}
+
+    print(f"{script.name}: {len(rows)} modules imported")
+    print(f"Total import time: best {min(totals) / 1000:.1f} ms, median {sorted(totals)[len(totals) // 2] / 1000:.1f} ms over {runs} run(s)")
+    print(f"\nSlowest top-level imports (last run):")
+    for module, _, cumulative_us, _ in top_level[:TOP_MODULES]:
+        print(f"  {cumulative_us / 1000:9.1f} ms  {module}")
+    print("\nImported at startup:")
+    for module in LAZY_MODULES:
+        print(f"  {module:<16} {'yes' if module in loaded else 'no'}")
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    script = Path(sys.argv[2]) if len(sys.argv) > 2 else APP_SCRIPT
+    report(runs, script.resolve())
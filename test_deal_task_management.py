@@ -0,0 +1,47 @@
+import pandas as pd
+
+import deal_task_management as app
+
+AS_OF_DATE = pd.Timestamp('2024-06-15')
+
+
+# Function to build a snapshot of two deals, as read back from a normalized snapshot workbook
+def make_snapshot():
+    deals = pd.DataFrame({col: [None, None] for col in app.DEAL_COLUMNS})
+    deals['Regarding'] = ['Deal A', 'Deal B']
+    deals[app.DEAL_DATE_COLUMNS] = pd.NaT
+    tasks = pd.DataFrame({
+        'Regarding': ['Deal A', 'Deal B', 'Deal B'],
+        'Subject': ['a1', 'b1', 'b2'],
+        'Status Reason': ['In Progress', 'Completed', 'In Progress'],
+        'Due Date': ['07/30/2024', '06/01/2024', '06/01/2024'],
+        'Actual End': ['06/02/2024', '06/01/2024', None],
+        'Modified On': ['06/01/2024', '06/01/2024', '06/01/2024']
+    })
+    appointments = pd.DataFrame(columns=app.APPOINTMENT_COLUMNS)
+    return {'Deals': deals, 'Tasks': tasks, 'Appointments': appointments}
+
+
+def test_merge_keeps_urgency_of_deals_outside_the_delta():
+    snapshot = make_snapshot()
+    delta_deals = snapshot['Deals'].iloc[[0]]
+    delta_tasks = pd.DataFrame({
+        'Regarding': ['Deal A', 'Deal A'],
+        'Subject': ['a1', 'a2'],
+        'Status Reason': ['In Progress', 'Not Started'],
+        'Due Date': ['07/30/2024', '08/30/2024'],
+        'Actual End': [None, None],
+        'Modified On': ['06/10/2024', '06/10/2024']
+    })
+
+    deals_df, tasks_df, appointments_df, deal_groups, affected_deals, _ = app.merge_delta_exports(
+        snapshot, (delta_deals, delta_tasks), None
+    )
+    urgency = app.compute_urgency(tasks_df, appointments_df, AS_OF_DATE)
+
+    assert affected_deals == {'Deal A'}
+    deal_b_tasks = app.with_urgency(deal_groups['Deal B']['tasks'], urgency['tasks']).set_index('Subject')
+    assert deal_b_tasks.loc['b2', 'Urgency'] == app.URGENCY_OVERDUE
+    assert deal_b_tasks.loc['b1', 'Urgency'] == app.URGENCY_NONE  # Completed
+    assert sorted(deal_groups['Deal A']['tasks']['Subject']) == ['a1', 'a2']
+    assert deal_groups['Deal B']['counts']['Show All'] == 2